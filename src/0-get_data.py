@@ -1,5 +1,6 @@
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 import csv
+import io
 import json
 import requests
 import os
@@ -9,10 +10,11 @@ from pyproj import Transformer
 
 import folium
 import utm
-from shapely.geometry import shape, Point
+from shapely.geometry import Point
 
 from datatypes import Count, CountPoint, P, City, Simulation
 from utilities import create_dir, store
+from spatial import LocalAuthorityLocator
 
 # We need to import python modules from the $SUMO_HOME/tools directory
 if 'SUMO_HOME' in os.environ:
@@ -22,21 +24,98 @@ else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
 
-# Add counts to the list of counts for point
-def aggregate_counts(count_point: CountPoint, raw_count):
+# Add counts to the list of counts for point, counts holds
+# the count of each point for each hour
+def aggregate_counts(count_point: CountPoint, raw_count, counts: Dict[Tuple[str, int], Count]):
 
-    for count in count_point.counts:
-        if (count.hour == int(raw_count[P.hour.value])):
-            # add count to average
-            count.value_sum += int(raw_count[P.cars_and_taxis.value])
-            count.value_count += 1
-            return
+    hour = int(raw_count[P.hour.value])
+    count = counts.get((count_point.id, hour))
+    if (count != None):
+        # add count to average
+        count.value_sum += int(raw_count[P.cars_and_taxis.value])
+        count.value_count += 1
+        return
 
-    count_point.counts.append(Count(
-        int(raw_count[P.hour.value]),
+    count = Count(
+        hour,
         int(raw_count[P.cars_and_taxis.value]),
         1
-    ))
+    )
+    count_point.counts.append(count)
+    counts[(count_point.id, hour)] = count
+
+# Reduce raw counts to average count at each count point, count points
+# and their counts are kept in the order they first appear in
+def aggregate_count_points(raw_counts) -> List[CountPoint]:
+
+    count_points: Dict[str, CountPoint] = {}
+    counts: Dict[Tuple[str, int], Count] = {}
+
+    for raw_count in raw_counts:
+
+        count_point_id = raw_count[P.count_point_id.value]
+        count_point = count_points.get(count_point_id)
+
+        # need to define count_point if it hasn't been added yet
+        if (count_point == None):
+            count_point = CountPoint(
+                count_point_id,
+                raw_count[P.road_name.value],
+                float(raw_count[P.latitude.value]),
+                float(raw_count[P.longitude.value]),
+                utm.from_latlon(
+                    float(raw_count[P.latitude.value]), 
+                    float(raw_count[P.longitude.value])
+                ),
+                [],
+                (-1, None)
+            )
+            count_points[count_point_id] = count_point
+
+        aggregate_counts(count_point, raw_count, counts)
+
+    return list(count_points.values())
+
+# Get path of the raw counts of a local authority, downloading
+# them first if they haven't been downloaded before
+def get_raw_counts_file(local_authority_id) -> str:
+
+    path = '../temp/dft_rawcount_local_authority_id_' + str(local_authority_id) + '.csv'
+    if (os.path.exists(path)):
+        print('Using cached raw counts in ' + path)
+        return path
+
+    response = requests.get(
+        'https://storage.googleapis.com/dft-statistics/road-traffic/downloads/rawcount/local_authority_id/' + \
+        'dft_rawcount_local_authority_id_' + str(local_authority_id) + '.csv', stream=True)
+    response.raise_for_status()
+
+    # Write to a temporary file first so that an interrupted download isn't cached
+    with open(path + '.part', 'wb') as outp:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            outp.write(chunk)
+    os.replace(path + '.part', path)
+
+    return path
+
+# Read raw counts row by row from a file path or a binary stream,
+# only yielding counts from max_year and before
+def stream_raw_counts(source, max_year: int) -> Iterator[List[str]]:
+
+    stream = open(source, 'rb') if isinstance(source, str) else source
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(text_stream)
+        next(reader, None)
+        for raw_count in reader:
+            if (raw_count and int(raw_count[P.year.value]) <= max_year):
+                yield raw_count
+    finally:
+        # Only close the stream if it was opened here
+        if (isinstance(source, str)):
+            text_stream.close()
+        else:
+            text_stream.detach()
 
 def run():
 
@@ -83,9 +162,7 @@ def run():
 
 
     # Figure out which local authority the city is in
-    with open('local_authorities.geojson', 'r') as myfile:
-        local_authorities_raw = myfile.read()
-    local_authorities = json.loads(local_authorities_raw)
+    locator = LocalAuthorityLocator.load('local_authorities.geojson')
 
     transformer = Transformer.from_crs("epsg:4326", "epsg:3857")
     city.position = Point(
@@ -95,11 +172,10 @@ def run():
         )
     )
 
-    for local_authority in local_authorities['features']:
-        multipolygon = shape(local_authority['geometry'])
-        if multipolygon.contains(city.position):
-            city.local_authority_id = int(local_authority['properties']['id'])
-            print("Found city in " + local_authority['properties']['Name'])
+    local_authority = locator.locate(city.position)
+    if (local_authority != None):
+        city.local_authority_id = int(local_authority['id'])
+        print("Found city in " + local_authority['Name'])
 
     if (city.local_authority_id == 0):
         sys.exit("Could not find city in any british local authority")
@@ -129,47 +205,15 @@ def run():
 
     
     # Get count point data for relevant local authority
-    x = requests.get(
-        'https://storage.googleapis.com/dft-statistics/road-traffic/downloads/rawcount/local_authority_id/' + \
-        'dft_rawcount_local_authority_id_' + str(city.local_authority_id) + '.csv');
-    raw_counts = x.text.split('\n');
-    raw_counts = list(csv.reader(raw_counts));
-    list.pop(raw_counts);
-    raw_counts.pop(0);
+    raw_counts_file = get_raw_counts_file(city.local_authority_id)
 
 
     # Reduce each count for a point at a certain time of day into one average value
     # Only include counts from 2019 and before
-    raw_counts = [point for point in raw_counts if int(point[P.year.value]) <= 2019];
-
-    count_points: List[CountPoint] = []
+    raw_counts = stream_raw_counts(raw_counts_file, 2019)
 
     # reduce raw counts to average count at each count point
-    for raw_count in raw_counts:
-
-        count_point_id = raw_count[P.count_point_id.value];
-        
-        # need to define count_point if it hasn't been added yet
-        if (count_point_id not in [point.id for point in count_points]):
-            new_count_point = CountPoint(
-                count_point_id,
-                raw_count[P.road_name.value],
-                float(raw_count[P.latitude.value]),
-                float(raw_count[P.longitude.value]),
-                utm.from_latlon(
-                    float(raw_count[P.latitude.value]), 
-                    float(raw_count[P.longitude.value])
-                ),
-                [],
-                (-1, None)
-            )
-            aggregate_counts(new_count_point, raw_count)
-            count_points.append(new_count_point)
-        # if count_point has already been defined, add count to it
-        else:
-            for count_point in count_points:
-                if (count_point.id == count_point_id):
-                    aggregate_counts(count_point, raw_count)
+    count_points: List[CountPoint] = aggregate_count_points(raw_counts)
 
 
     # Write data to file
@@ -1,75 +1,94 @@
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
 import math
-import random
 import os
-import sys
-import xml.etree.ElementTree as ET
 
+import numpy as np
 from tqdm import tqdm
 
-from datatypes import CountPoint, Edge, Taz, Simulation, Trip, Driver
-from utilities import retrieve, store, generate_config, indent
-
-# We need to import python modules from the $SUMO_HOME/tools directory
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-    from sumolib import checkBinary
-    import traci
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
-
-
-# Generate a mock route file in order to run simulation
-def generate_temp_route_file():
-    temp_routes_root = ET.Element('routes')
-
-    taxi_def = ET.SubElement(temp_routes_root, 'vType', {
-        'id': 'taxi',
-        'vClass': 'taxi',
-        'personCapacity': '8'
-    })
-    ET.SubElement(taxi_def, 'param', {
-        'key': 'has.taxi.device',
-        'value': 'true'
-    })
-
-    temp_trips_tree = ET.ElementTree(temp_routes_root)
-    indent(temp_routes_root)
-    temp_trips_tree.write('../temp/temp.routes.xml', encoding='utf-8', xml_declaration=True)
-    return '../temp/temp.routes.xml'
-
-# Retrieve random drivable edge
-def get_random_drivable_edge(tazs, edges, drivable_edges) -> Edge:
-    if (random.random() <= 0.5):
-        rand = random.random()
-        ac_weight = 0
-        for taz in tazs:
-            ac_weight += taz.weight
-            if (rand <= ac_weight):
-                edge_id = random.choice(taz.drivable_edges)
-                return next(edge for edge in edges if edge.id == edge_id)
-    else:
-        edge_id = random.choice(list(drivable_edges))
-        return next(edge for edge in edges if edge.id == edge_id)
+from datatypes import CountPoint, Simulation, Trip, Driver
+from utilities import retrieve, store
+from network import Network
+from sampling import EdgeSampler, TazEdges, schedule_trips
+from routing import Reachability, Router, RouteCache
+
+
+# Drivers are only placed on edges from which every other edge they could be
+# placed on is reachable, set to True to also find each driver's routes with the router
+verify_routes = False
+
+# Drivers are generated in shards of a fixed size, each with its own seed derived
+# from the simulation seed, so the result doesn't depend on the number of workers
+worker_count = os.cpu_count() or 1
+drivers_per_shard = 10000
+
+# Data used by the process generating drivers
+worker_state = {}
+
+
+# Set up process which generates drivers, each worker has its own
+# edge sampler and router
+def init_driver_worker(taz_edges: TazEdges, allowed_edges: np.ndarray):
+    network: Network = retrieve('../temp/edges.bin')
+    worker_state['edge_ids'] = network.edge_ids
+    worker_state['edge_sampler'] = EdgeSampler(taz_edges, network, None, allowed_edges)
+    if (verify_routes):
+        worker_state['route_cache'] = RouteCache(Router(network, 'taxi').find_route)
+
+# Generate the home and destination edge indices of the drivers of one shard
+def generate_driver_shard(shard: Tuple[int, np.random.SeedSequence]) -> Tuple[np.ndarray, np.ndarray]:
+    shard_size, shard_seed = shard
+    edge_ids = worker_state['edge_ids']
+    edge_sampler: EdgeSampler = worker_state['edge_sampler']
+    edge_sampler.reseed(shard_seed)
+
+    home_edges = np.empty(shard_size, dtype=np.int64)
+    destination_edges = np.empty(shard_size, dtype=np.int64)
+    pending_drivers = np.arange(shard_size)
+    while len(pending_drivers) > 0:
+
+        # Retrieve two random distinct edges for each driver
+        home_edges[pending_drivers], destination_edges[pending_drivers] = edge_sampler.sample_pair_indices(len(pending_drivers))
+
+        # Both edges are in the same component so each can be reached from the other,
+        # only find the routes to check this when verifying
+        if (not verify_routes):
+            break
+
+        route_cache: RouteCache = worker_state['route_cache']
+        retry_drivers = []
+        for driver in pending_drivers:
+            start_edge_id = edge_ids[home_edges[driver]]
+            end_edge_id = edge_ids[destination_edges[driver]]
+            if (not route_cache.is_reachable(start_edge_id, end_edge_id, 'taxi') or not route_cache.is_reachable(end_edge_id, start_edge_id, 'taxi')):
+                print('Route between {} and {} not found by the router'.format(start_edge_id, end_edge_id))
+                retry_drivers.append(driver)
+        pending_drivers = np.array(retry_drivers, dtype=np.int64)
+
+    return home_edges, destination_edges
+
+# Set the home and destination edges of drivers from the results of their shards,
+# shards come back in order, so drivers are the same whatever the number of workers
+def place_drivers(drivers: List[Driver], shard_results, edges):
+    progress = tqdm(total=len(drivers), desc='Generating drivers')
+    driver_index = 0
+    for home_edges, destination_edges in shard_results:
+        for home_edge, destination_edge in zip(home_edges.tolist(), destination_edges.tolist()):
+            drivers[driver_index].home_edge = edges[home_edge]
+            drivers[driver_index].destination_edge = edges[destination_edge]
+            driver_index += 1
+        progress.update(len(home_edges))
+    progress.close()
 
 def run():
 
     # Retrieve data
     count_points: List[CountPoint] = retrieve('../temp/filtered_count_points.pkl')
-    tazs: List[Taz] = retrieve('../temp/tazs.pkl')
-    edges: List[Edge] = retrieve('../temp/edges.pkl')
-    drivable_edges: List[str] = retrieve('../temp/drivable_edges.pkl')
+    taz_edges: TazEdges = retrieve('../temp/taz_edges.pkl')
+    network: Network = retrieve('../temp/edges.bin')
     simulation: Simulation = retrieve('../temp/simulation.pkl')
 
 
-    # Start sumo
-    generate_config(simulation.net_file, generate_temp_route_file(), simulation.start_time, simulation.end_time, '../temp/temp.sumocfg', True)
-    sumoBinary = checkBinary('sumo')
-    traci.start([sumoBinary, "-c", '../temp/temp.sumocfg'])
-    traci.simulationStep()
-
-
     # Calculate traffic distribution based on count point data
     aggregated_counts = [{'sum': 0, 'count': 0, 'average': 0, 'distribution_value': 0} for i in range(1, 23)];
 
@@ -108,58 +127,29 @@ def run():
     total_trips = total_drivers*2
 
     drivers: List[Driver] = [Driver('', '', None, None) for i in range(total_drivers)]
-    for driver in tqdm(drivers, desc='Generating drivers'):
-        route_is_possible = False
-        while not route_is_possible:
-
-            # Retrieve two random distinct edges
-            start_edge = get_random_drivable_edge(tazs, edges, drivable_edges)
-            end_edge = get_random_drivable_edge(tazs, edges, drivable_edges)
-            if (start_edge == end_edge):
-                continue
-
-            # Check that it is possible to travel to each point from the other
-            route_1 = traci.simulation.findRoute(start_edge.id, end_edge.id, vType='taxi')
-            route_2 = traci.simulation.findRoute(end_edge.id, start_edge.id, vType='taxi')
-
-            if (route_1.length != 0 and route_2.length != 0):
-                route_is_possible = True
-                driver.home_edge = start_edge
-                driver.destination_edge = end_edge
+    driver_seed, trip_seed = np.random.SeedSequence(simulation.seed).spawn(2)
+    reachability = Reachability(network, 'taxi')
+    allowed_edges = reachability.giant_component_edges()
+
+    shard_sizes = [min(drivers_per_shard, total_drivers-start) for start in range(0, total_drivers, drivers_per_shard)]
+    shards = list(zip(shard_sizes, driver_seed.spawn(len(shard_sizes))))
+    worker_args = (taz_edges, allowed_edges)
+    edges = network.edges()
+    if (worker_count > 1 and len(shards) > 1):
+        with ProcessPoolExecutor(min(worker_count, len(shards)), initializer=init_driver_worker, initargs=worker_args) as executor:
+            place_drivers(drivers, executor.map(generate_driver_shard, shards), edges)
+    else:
+        init_driver_worker(*worker_args)
+        place_drivers(drivers, map(generate_driver_shard, shards), edges)
 
     
     # Generate trips
     # For each hour, generate trips
-    trip_id = 0
-    for hour in tqdm(range(simulation.start_hour, simulation.end_hour+1), desc='Generating trips'):
-        trip_count = math.floor(total_trips * aggregated_counts[hour]['distribution_value'])
-        generated_trip_count = 0
-        processed_drivers = []
-
-        while generated_trip_count != trip_count:
-            driver = random.choice(drivers)
-            if (driver in processed_drivers):
-                continue
-            
-            if (driver.trip1 == None):
-                driver.trip1 = Trip(
-                    trip_id,
-                    float(hour*3600 + round(random.random()*3600)),
-                    driver.home_edge.id,
-                    driver.destination_edge.id
-                )
-            elif (driver.trip2 == None):
-                driver.trip2 = Trip(
-                    trip_id,
-                    float(hour*3600 + round(random.random()*3600)),
-                    driver.destination_edge.id,
-                    driver.home_edge.id
-                )
-            else:
-                continue
-
-            generated_trip_count += 1
-            trip_id += 1
+    hourly_trip_counts = {
+        hour: math.floor(total_trips * aggregated_counts[hour]['distribution_value'])
+        for hour in range(simulation.start_hour, simulation.end_hour+1)
+    }
+    schedule_trips(drivers, hourly_trip_counts, np.random.default_rng(trip_seed))
 
     trips: List[Trip] = []
     trips.extend([driver.trip1 for driver in drivers if driver.trip1 != None])
@@ -169,11 +159,7 @@ def run():
 
     # Write data to file
     store(trips, '../temp/trips.pkl')
-    store(simulation, '../temp/simulation.pkl')
-
-
-    # Stop SUMO
-    traci.close()
+    store(simulation, '../temp/demand_simulation.pkl')
         
 
 if __name__ == '__main__':
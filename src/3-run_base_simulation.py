@@ -1,48 +1,124 @@
-from typing import List
+from typing import Iterable, Iterator, List
+from concurrent.futures import ThreadPoolExecutor
+import os
 import subprocess
 import xml.etree.ElementTree as ET
 
 from tqdm import tqdm
 
 from datatypes import Trip, Simulation
-from utilities import create_dir, retrieve, indent, generate_config
+from utilities import create_dir, retrieve, retrieve_iter, generate_config, write_xml_stream
+from tripinfo import read_trip_infos, store_trip_infos
 
 
-# Generate file containing trip definitions
-def generate_trips_file(trips: List[Trip]):
-    base_trips_root = ET.Element('routes')
+# Write trips file compressed with gzip, which SUMO reads directly
+compress_trips = False
 
-    for trip in tqdm(trips, desc='Generating base.trips.xml'):
-        ET.SubElement(base_trips_root, 'trip', {
+# Routing is split into shards of about this many trips, with up to routing_workers
+# duarouter processes running at once. Shards are only cut between different
+# departure times, so appending the shard outputs keeps the routes sorted
+routing_workers = os.cpu_count() or 1
+trips_per_shard = 50000
+
+# Threads used by each duarouter process, None leaves it to duarouter
+routing_threads = None
+
+
+# Generate file containing trip definitions, trips are written as they
+# are read so they never all need to be in memory
+def generate_trips_file(trips: Iterable[Trip], path: str = '../temp/base.trips.xml'):
+    path = path + ('.gz' if compress_trips else '')
+
+    write_xml_stream(path, 'routes', (
+        ET.Element('trip', {
                 'id': str(trip.id), 
                 'depart': str(trip.depart),
                 'from': trip.from_,
                 'to': trip.to
             })
+        for trip in tqdm(trips, desc='Generating ' + os.path.basename(path))
+    ))
+
+    return path
+
+def duarouter_options(simulation: Simulation, trips_file: str, routes_file: str) -> List[str]:
+    options = ['duarouter',
+               '--net-file', '../temp/' + simulation.net_file,
+               '--route-files', trips_file,
+               '--output-file', routes_file,
+               '--ignore-errors', 'true',
+               '--repair', 'true',
+               '--unsorted-input', 'true',
+               '--no-warnings', 'true']
+    if (routing_threads != None):
+        options += ['--routing-threads', str(routing_threads)]
+    return options
+
+# Split trips sorted by departure time into consecutive shards of at least
+# the given size, trips departing at the same time are kept in the same shard
+def shard_trips(trips: Iterable[Trip], size: int) -> Iterator[List[Trip]]:
+    shard: List[Trip] = []
+    for trip in trips:
+        if (len(shard) >= size and trip.depart != shard[-1].depart):
+            yield shard
+            shard = []
+        shard.append(trip)
+    if (shard):
+        yield shard
+
+# Concatenate the vehicles of duarouter route files into a single route file,
+# the declaration and root element are taken from the first file
+def merge_route_files(route_files: List[str], output_file: str):
+    with open(output_file, 'w', encoding='utf-8') as outp:
+        for i, route_file in enumerate(route_files):
+            with open(route_file, 'r', encoding='utf-8') as openfile:
+                in_routes = False
+                for line in openfile:
+                    if (line.startswith('</routes>')):
+                        break
+                    if (in_routes or i == 0):
+                        outp.write(line)
+                    if (line.startswith('<routes')):
+                        in_routes = True
+        outp.write('</routes>\n')
+
+# Route trips shard by shard with duarouter processes running in parallel, then
+# merge the shards into the route file. Each trip is routed independently so
+# the result is the same as routing all trips with a single duarouter process
+def route_trips_sharded(trips: Iterable[Trip], simulation: Simulation):
+    trips_files = []
+    for i, shard in enumerate(shard_trips(trips, trips_per_shard)):
+        trips_files.append(generate_trips_file(shard, '../temp/base.trips.{}.xml'.format(i)))
+    routes_files = ['../temp/base.routes.{}.xml'.format(i) for i in range(len(trips_files))]
+
+    with ThreadPoolExecutor(max_workers=routing_workers) as executor:
+        list(executor.map(subprocess.check_call, [
+            duarouter_options(simulation, trips_file, routes_file)
+            for trips_file, routes_file in zip(trips_files, routes_files)
+        ]))
 
-    base_trips_tree = ET.ElementTree(base_trips_root)
-    indent(base_trips_root)
-    base_trips_tree.write('../temp/base.trips.xml', encoding='utf-8', xml_declaration=True)
+    merge_route_files(routes_files, '../temp/' + simulation.base_routes_file)
 
-    return '../temp/base.trips.xml'
+    for trips_file, routes_file in zip(trips_files, routes_files):
+        os.remove(trips_file)
+        os.remove(routes_file)
+        alternatives_file = routes_file[:-len('.xml')] + '.alt.xml'
+        if (os.path.exists(alternatives_file)):
+            os.remove(alternatives_file)
 
 def run():
 
     # Retrieve data
-    trips: List[Trip] = retrieve('../temp/trips.pkl')
-    simulation: Simulation = retrieve('../temp/simulation.pkl')
+    trips: Iterator[Trip] = retrieve_iter('../temp/trips.pkl')
+    simulation: Simulation = retrieve('../temp/demand_simulation.pkl')
 
 
-    # Generate routes from trips using duarouter
-    duarouter_options = ['duarouter',
-                        '--net-file', '../temp/' + simulation.net_file,
-                        '--route-files', generate_trips_file(trips),
-                        '--output-file', '../temp/' + simulation.base_routes_file,
-                        '--ignore-errors', 'true',
-                        '--repair', 'true',
-                        '--unsorted-input', 'true',
-                        '--no-warnings', 'true']
-    subprocess.check_call(duarouter_options)
+    # Generate routes from trips using duarouter, when sharding only the shards are written
+    if (routing_workers > 1):
+        route_trips_sharded(trips, simulation)
+    else:
+        trips_file = generate_trips_file(trips)
+        subprocess.check_call(duarouter_options(simulation, trips_file, '../temp/' + simulation.base_routes_file))
 
 
     # Run the simulation using the sumo program
@@ -51,6 +127,7 @@ def run():
                     '--configuration-file', '../temp/base.sumocfg',
                     '--tripinfo-output', '../temp/base.tripinfo.xml']
     subprocess.check_call(sumo_options)
+    store_trip_infos(read_trip_infos('../temp/base.tripinfo.xml'), '../temp/base.tripinfo.npz')
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
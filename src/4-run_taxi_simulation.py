@@ -1,64 +1,133 @@
 from __future__ import absolute_import
 from __future__ import print_function
-import os
-import sys
+import argparse
 import math
 import time
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+import itertools
 import random
 import xml.etree.ElementTree as ET
 
+import numpy as np
 from tqdm import tqdm
 
-from datatypes import Trip, Simulation, TaxiStates, ReservationStates, Taxi, TaxiSimulationLog
-from utilities import create_dir, store, retrieve, indent, generate_config
+from datatypes import Trip, Simulation, TaxiStates, ReservationStates, Taxi, TaxiSimulationLog, DispatchLog
+from utilities import retrieve, retrieve_iter, generate_config, write_xml_stream
+from tripinfo import read_ride_infos, store_trip_infos, compute_kpis
+from fleet import FleetSnapshot, FleetRegistry
+from spatial import PointGrid
+from assignment import assign
+from network import Network
+from routing import Router, RouteCache
+from pooling import Stop, Insertion, remaining_reservation_ids, taxi_stops, insert_reservation
+from telemetry import TelemetrySink
+from sumo_backend import checkBinary, load_backend, add_backend_argument
 
-# We need to import python modules from the $SUMO_HOME/tools directory
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-    from sumolib import checkBinary
-    import traci
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
+# Module used to talk to SUMO, either traci or libsumo
+traci = load_backend()
 
 
 # Instantiate global variables
 verbose = False
-drivable_edges = []
-taxis: List[Taxi] = []
-
-
-# Generates the file containing the description of the taxis and the trips
-def generate_trips_file(trips: List[Trip], simulation: Simulation):
+compress_trips = False
+drivable_edges: List[str] = []
+fleet = FleetRegistry()
+fleet_snapshot: FleetSnapshot = None
+idle_taxi_grid: PointGrid = None
+router: Router = None
+route_cache: RouteCache = None
+
+# Distance in metres driven by taxis which have left the simulation
+retired_taxi_distance = 0.0
+
+# Seats in each taxi
+taxi_capacity = 8
+
+# Routes are found by the router on the travel times of the empty network, set to True
+# to look them up in SUMO instead, which follows congestion but is much slower
+route_with_sumo = False
+
+# Routes from taxis to pickups are cached, and looked up again once they are older
+# than route_cache_ttl seconds, or unreachable_route_cache_ttl seconds for pairs of
+# edges with no route between them. None keeps them until they are pushed out. The
+# ttl only applies to routes from SUMO, those of the router never change
+route_cache_size = 100000
+route_cache_ttl = 300
+unreachable_route_cache_ttl = None
+
+# Idle taxis are kept in a grid with cells of this size in metres, and the greedy
+# dispatcher only checks whether the nearest few of them can reach a reservation
+idle_taxi_cell_size = 500
+nearest_taxi_count = 10
+
+# How taxis are dispatched, one of 'first', 'greedy', 'batch' or 'pooling'. The batch
+# policy matches all queued reservations to idle taxis every dispatch_period
+# seconds, which is also set as SUMO's device.taxi.dispatch-period, only considering
+# the batch_nearest_taxi_count taxis nearest to each reservation, or every idle taxi
+# if it is None. Other policies dispatch every second
+dispatch_policies = ['first', 'greedy', 'batch', 'pooling']
+dispatch_policy = 'greedy'
+dispatch_period = 60
+batch_nearest_taxi_count = 20
+
+# The pooling policy adds reservations to the stops of taxis which are already busy,
+# out of the pooling_nearest_taxi_count busy taxis nearest to the person, when it takes
+# less time than sending an idle taxi. People have to be picked up within
+# pooling_max_waiting_time seconds of making their reservation, and their ride can
+# take at most pooling_max_detour times as long as going straight to their destination,
+# or pooling_detour_allowance seconds longer for short rides
+pooling_nearest_taxi_count = 10
+pooling_max_waiting_time = 600
+pooling_max_detour = 1.5
+pooling_detour_allowance = 180
+
+# Deadlines of the stops of reservations dispatched by the pooling policy, by
+# reservation id and whether the stop is the pickup
+pooling_deadlines: Dict[Tuple[str, bool], float] = {}
+
+
+# Name of an output of the run with the dispatch policy in it, so that runs with
+# different policies can be compared, eg. taxi.tripinfo.xml becomes taxi_greedy.tripinfo.xml
+def policy_file_name(name: str) -> str:
+    return name.replace('taxi', 'taxi_' + dispatch_policy, 1)
+
+# Generate a person element riding a taxi for a trip
+def trip_person(trip: Trip) -> ET.Element:
+    person = ET.Element('person', {
+        'id': str(trip.id), 
+        'depart': str(trip.depart),
+        'color': 'green'
+    })
+    ET.SubElement(person, 'ride', {
+        'from': trip.from_,
+        'to': trip.to,
+        'lines': 'taxi'
+    })
+    return person
 
-    taxi_routes_root = ET.Element("routes")
+# Generates the file containing the description of the taxis and the trips, trips
+# are written as they are read so they never all need to be in memory. Returns
+# the name of the file, which ends in .gz when it is compressed
+def generate_trips_file(trips: Iterable[Trip], simulation: Simulation) -> str:
 
-    taxi_def = ET.SubElement(taxi_routes_root, 'vType', {
+    taxi_def = ET.Element('vType', {
         'id': 'taxi',
         'vClass': 'taxi',
-        'personCapacity': '8'
+        'personCapacity': str(taxi_capacity)
     })
     ET.SubElement(taxi_def, 'param', {
         'key': 'has.taxi.device',
         'value': 'true'
     })
-    
-    for trip in tqdm(trips):
-        person = ET.SubElement(taxi_routes_root, 'person', {
-            'id': str(trip.id), 
-            'depart': str(trip.depart),
-            'color': 'green'
-        })
-        ET.SubElement(person, 'ride', {
-            'from': trip.from_,
-            'to': trip.to,
-            'lines': 'taxi'
-        })
-
-    taxi_routes_tree = ET.ElementTree(taxi_routes_root)
-    indent(taxi_routes_root)
-    taxi_routes_tree.write('../temp/' + simulation.taxi_routes_file, encoding="utf-8", xml_declaration=True)
+
+    taxi_routes_file = policy_file_name(simulation.taxi_routes_file) + ('.gz' if compress_trips else '')
+    write_xml_stream('../temp/' + taxi_routes_file, 'routes', itertools.chain(
+        [taxi_def],
+        (trip_person(trip) for trip in tqdm(trips))
+    ))
+
+    return taxi_routes_file
 
 
 # Create a new taxi and insert it into the simulation
@@ -66,194 +135,467 @@ taxi_count = 0
 def new_taxi() -> Taxi:
 
     global drivable_edges
-    global taxis
     global taxi_count
     
     route_id = 'route'+str(taxi_count)
-    traci.route.add(route_id, [random.choice(list(drivable_edges))])
+    traci.route.add(route_id, [random.choice(drivable_edges)])
 
     new_taxi = Taxi('v'+str(taxi_count))
     traci.vehicle.add(new_taxi.id, route_id, 'taxi', depart=f'{traci.simulation.getTime()}', line='taxi')
-    taxis.append(new_taxi)
+    fleet_snapshot.add(new_taxi.id)
+    fleet.add(new_taxi)
 
     taxi_count += 1
     return new_taxi
 
 
+# Remove taxi from simulation
+def remove_taxi(taxi: Taxi):
+    global retired_taxi_distance
+    if (fleet_snapshot.has_position(taxi.id)):
+        retired_taxi_distance += fleet_snapshot.distance(taxi.id)
+    fleet.remove(taxi.id)
+    fleet_snapshot.remove(taxi.id)
+    if (taxi.id in idle_taxi_grid):
+        idle_taxi_grid.remove(taxi.id)
+    traci.vehicle.remove(taxi.id)
+
+
+# Kilometres driven by the whole fleet so far, including taxis which have left
+def fleet_vkt() -> float:
+    distance = retired_taxi_distance
+    for taxi_id in fleet.taxis:
+        if (fleet_snapshot.has_position(taxi_id)):
+            distance += fleet_snapshot.distance(taxi_id)
+    return distance/1000
+
+
 # Remove taxi from simulation and replace it with new one
 def replace_taxi(taxi) -> Taxi:
-    taxis.remove(taxi)
-    traci.vehicle.remove(taxi.id)
+    remove_taxi(taxi)
     replacement_taxi = new_taxi()
     if (verbose):
         print('Replacing taxi {} with {} at time {}'.format(taxi.id, replacement_taxi.id, traci.simulation.getTime()))
     return replacement_taxi
 
 
+# Count a reservation an idle taxi couldn't reach. Taxis which weren't able to reach
+# reservations 10 times are probably in some weird spot of the network, so they
+# are replaced, which also takes them out of the idle taxis
+def count_unreachable_reservation(taxi: Taxi):
+    taxi.unreachable_reservations_count += 1
+    if (taxi.unreachable_reservations_count > 10):
+        replace_taxi(taxi)
+
+
+# Move the idle taxis in the grid to where they are now, as idle taxis keep
+# circling. Taxis which are no longer idle are taken out of the grid
+def update_idle_taxi_grid(idle_taxis: Dict[str, Taxi]):
+    for taxi_id in [taxi_id for taxi_id in idle_taxi_grid.points if taxi_id not in idle_taxis]:
+        idle_taxi_grid.remove(taxi_id)
+    for taxi_id, taxi in idle_taxis.items():
+        if (fleet_snapshot.has_position(taxi_id)):
+            idle_taxi_grid.move(taxi_id, fleet_snapshot.position(taxi_id), taxi)
+
+
+# Bring the fleet up to date after a simulation step, keeping the distance driven by
+# taxis which left the simulation by themselves. Returns the idle taxis by id, which
+# the fleet registry keeps up to date, after moving them in the idle taxi grid
+def update_fleet() -> Dict[str, Taxi]:
+    global retired_taxi_distance
+
+    fleet_snapshot.refresh()
+    for taxi in fleet.update(fleet_snapshot):
+        retired_taxi_distance += fleet_snapshot.vanished_distances.get(taxi.id, 0.0)
+        # Taxis can mysteriously disappear from the simulation
+        if (verbose):
+            print('Taxi {} left the simulation at time {}'.format(taxi.id, traci.simulation.getTime()))
+
+    idle_taxis = fleet.in_state(TaxiStates.idle)
+    update_idle_taxi_grid(idle_taxis)
+    return idle_taxis
+
+
+# Mark an idle taxi which was just dispatched as on its way to a pickup, SUMO
+# reports the same from the next step on
+def taxi_dispatched(taxi: Taxi):
+    fleet.set_state(taxi.id, TaxiStates.pickup)
+    if (taxi.id in idle_taxi_grid):
+        idle_taxi_grid.remove(taxi.id)
+
+
 # Taxi dispatch method which just sends the first idle taxi available
-def dispatch_taxi_first(reservation, idle_taxis):
+def dispatch_taxi_first(reservation, idle_taxis: Dict[str, Taxi], idle_taxi_grid: PointGrid):
 
     pickup_edge_id = reservation.fromEdge
 
-    for taxi in idle_taxis:
-        taxi_edge_id = traci.vehicle.getRoadID(taxi.id)
-        route = traci.simulation.findRoute(taxi_edge_id, pickup_edge_id, vType='taxi')
+    for taxi in list(idle_taxis.values()):
+        if (not fleet_snapshot.has_position(taxi.id)):
+            continue
+        taxi_edge_id = fleet_snapshot.road_id(taxi.id)
+        route = route_cache.find_route(taxi_edge_id, pickup_edge_id, 'taxi')
         
         if (route.length != 0):
             return taxi
         else:
-            taxi.unreachable_reservations_count += 1
-            # Remove taxis which weren't able to reach reservations 10 times
-            # as they are probably in some weird spot of the network
-            if (taxi.unreachable_reservations_count > 10):
-                replace_taxi(taxi)
-                idle_taxis.remove(taxi)
+            count_unreachable_reservation(taxi)
 
     return None
 
 
-# Taxi dispatch method which sends the closest idle taxi available
-def dispatch_taxi_greedy(reservation, idle_taxis):
+# Taxi dispatch method which sends the closest idle taxi available, out
+# of the nearest_taxi_count idle taxis closest to the person
+def dispatch_taxi_greedy(reservation, idle_taxis: Dict[str, Taxi], idle_taxi_grid: PointGrid):
 
     pickup_edge_id = reservation.fromEdge
     person_id = reservation.persons[0]
     person_pos = traci.person.getPosition(person_id)
-    closest_taxi = (0, None)
-    
-    for taxi in idle_taxis:
-        taxi_pos = traci.vehicle.getPosition(taxi.id)
-        dist = math.pow(taxi_pos[0]-person_pos[0], 2) + math.pow(taxi_pos[1]-person_pos[1], 2)
-        if (closest_taxi[0] == 0 or dist < closest_taxi[0]):
-            taxi_edge_id = traci.vehicle.getRoadID(taxi.id)
-            route = None if taxi_edge_id=='' else traci.simulation.findRoute(taxi_edge_id, pickup_edge_id, vType='taxi')
-            if (route == None or route.length != 0):
-                closest_taxi = (dist, taxi)
+
+    for _, taxi in idle_taxi_grid.nearest(person_pos, nearest_taxi_count):
+        taxi_edge_id = fleet_snapshot.road_id(taxi.id)
+        route = None if taxi_edge_id=='' else route_cache.find_route(taxi_edge_id, pickup_edge_id, 'taxi')
+        if (route == None or route.length != 0):
+            return taxi
+        else:
+            count_unreachable_reservation(taxi)
+
+    return None
+
+
+# Taxi dispatch method which matches queued reservations to idle taxis all at once,
+# minimising the total straight line distance between taxis and people. Returns
+# the pairs of reservation and taxi which can reach it, other reservations stay queued
+def dispatch_taxis_batch(reservations: List, idle_taxis: Dict[str, Taxi], idle_taxi_grid: PointGrid):
+
+    if (len(reservations) == 0 or len(idle_taxis) == 0):
+        return []
+
+    taxi_list = [taxi for taxi in idle_taxis.values() if fleet_snapshot.has_position(taxi.id)]
+    if (len(taxi_list) == 0):
+        return []
+    person_positions = np.array([traci.person.getPosition(reservation.persons[0]) for reservation in reservations])
+    taxi_positions = np.array([fleet_snapshot.position(taxi.id) for taxi in taxi_list])
+    reservation_indices, taxi_indices = assign(person_positions, taxi_positions, batch_nearest_taxi_count, idle_taxi_cell_size)
+    matches = [(reservations[i], taxi_list[j]) for i, j in zip(reservation_indices.tolist(), taxi_indices.tolist())]
+
+    assignments = []
+    for reservation, taxi in matches:
+        taxi_edge_id = fleet_snapshot.road_id(taxi.id)
+        route = None if taxi_edge_id=='' else route_cache.find_route(taxi_edge_id, reservation.fromEdge, 'taxi')
+        if (route == None or route.length != 0):
+            assignments.append((reservation, taxi))
+        else:
+            count_unreachable_reservation(taxi)
+
+    return assignments
+
+
+# Taxi dispatch method which adds the reservation to the stops of the taxi, idle or
+# busy, for which it adds the least time, within the waiting time and detour bounds.
+# Reservations are only known to SUMO until they are over, so active_reservations
+# holds those which are ongoing by id. Returns the taxi and its new stops
+def dispatch_taxi_pooling(reservation, active_reservations: Dict, picked_up_ids, idle_taxi_grid: PointGrid,
+                          busy_taxi_grid: PointGrid) -> Tuple[Optional[Taxi], Optional[Insertion]]:
+
+    now = traci.simulation.getTime()
+    person_pos = traci.person.getPosition(reservation.persons[0])
+    direct_time = travel_time(reservation.fromEdge, reservation.toEdge)
+    if (direct_time == None):
+        return None, None
+    pickup = Stop(reservation.id, reservation.fromEdge, True, len(reservation.persons), reservation.reservationTime + pooling_max_waiting_time)
+    dropoff = Stop(reservation.id, reservation.toEdge, False, len(reservation.persons), math.inf)
+
+    max_ride_time = max(pooling_max_detour*direct_time, direct_time + pooling_detour_allowance)
+
+    candidates = itertools.chain(idle_taxi_grid.nearest(person_pos, nearest_taxi_count),
+                                 busy_taxi_grid.nearest(person_pos, pooling_nearest_taxi_count))
+    best_taxi, best = None, None
+    for _, taxi in candidates:
+        taxi_edge_id = fleet_snapshot.road_id(taxi.id)
+        # Routes can't be looked up from inside junctions
+        if (taxi_edge_id == '' or taxi_edge_id.startswith(':')):
+            continue
+        taxi.pickup = remaining_reservation_ids(taxi.pickup, active_reservations, picked_up_ids)
+        stops, onboard_count = taxi_stops(taxi.pickup, active_reservations, pooling_deadlines)
+        insertion = insert_reservation(taxi_edge_id, now, stops, onboard_count, taxi_capacity,
+                                       pickup, dropoff, max_ride_time, travel_time)
+        if (insertion != None and (best == None or insertion.cost < best.cost)):
+            best_taxi, best = taxi, insertion
+
+    return best_taxi, best
+
+
+# Set the deadlines of a reservation sent an idle taxi without pooling, so
+# that later reservations can be fitted in before its stops
+def set_pooling_deadlines(reservation, taxi: Taxi):
+    now = traci.simulation.getTime()
+    taxi_edge_id = fleet_snapshot.road_id(taxi.id) if fleet_snapshot.has_position(taxi.id) else ''
+    pickup_time = None if taxi_edge_id=='' else travel_time(taxi_edge_id, reservation.fromEdge)
+    direct_time = travel_time(reservation.fromEdge, reservation.toEdge)
+    if (pickup_time == None or direct_time == None):
+        return
+    pickup_time += now
+    max_ride_time = max(pooling_max_detour*direct_time, direct_time + pooling_detour_allowance)
+    pooling_deadlines[(reservation.id, True)] = max(reservation.reservationTime + pooling_max_waiting_time, pickup_time)
+    pooling_deadlines[(reservation.id, False)] = pickup_time + max_ride_time
+
+
+# Find route from one edge to another with the router, only asking SUMO for routes
+# from edges inside junctions, which the router has no connections for
+def find_route(from_edge_id: str, to_edge_id: str, vType: str = ''):
+    if (router == None or from_edge_id.startswith(':') or to_edge_id.startswith(':')):
+        return traci.simulation.findRoute(from_edge_id, to_edge_id, vType=vType)
+    return router.find_route(from_edge_id, to_edge_id, vType)
+
+# Seconds to drive from one edge to another, None if there is no route
+def travel_time(from_edge_id: str, to_edge_id: str) -> Optional[float]:
+    if (from_edge_id == to_edge_id):
+        return 0.0
+    route = route_cache.find_route(from_edge_id, to_edge_id, 'taxi')
+    return route.travelTime if route.length != 0 else None
+
+
+# Send taxi to pick up reservation, or to make the stops of the given reservation
+# ids in order when pooling, returns whether SUMO accepted the dispatch
+def send_taxi(taxi: Taxi, reservation, reservation_ids: List[str] = None) -> bool:
+    if (reservation_ids == None):
+        reservation_ids = [reservation.id, reservation.id]
+    try:
+        traci.vehicle.dispatchTaxi(taxi.id, reservation_ids)
+        taxi.pickup = reservation_ids
+        if (verbose):
+            print('Dispatched taxi {} for reservation {}'.format(taxi.id, reservation.id))
+        return True
+    except:
+        if (verbose):
+            print("Failed to dispatch taxi {} for reservation {} at time {}".format(taxi.id, reservation.id, traci.simulation.getTime()))
+        return False
+
+
+# Dispatch taxis to the queued reservations with the dispatch policy, reservations
+# which weren't dispatched stay in the queue to be tried again next step. The batch
+# policy only dispatches every period seconds. Returns the number of dispatches
+# and how many of them were pooled
+def dispatch_reservations(reservations_queue: deque, idle_taxis: Dict[str, Taxi], telemetry: TelemetrySink,
+                          period: int = 1) -> Tuple[int, int]:
+
+    step_dispatches = 0
+    step_pooled_dispatches = 0
+    if (dispatch_policy == 'batch'):
+        if (traci.simulation.getTime()%period == 0):
+            assignments = dispatch_taxis_batch(list(reservations_queue), idle_taxis, idle_taxi_grid)
+            assigned_reservation_ids = set()
+            for reservation, taxi in assignments:
+                if (send_taxi(taxi, reservation)):
+                    step_dispatches += 1
+                    telemetry.record_dispatch(traci.simulation.getTime() - reservation.reservationTime)
+                    taxi_dispatched(taxi)
+                assigned_reservation_ids.add(reservation.id)
+            if (assigned_reservation_ids):
+                unassigned_reservations = [reservation for reservation in reservations_queue if reservation.id not in assigned_reservation_ids]
+                reservations_queue.clear()
+                reservations_queue.extend(unassigned_reservations)
+    elif (dispatch_policy == 'pooling'):
+        if (len(reservations_queue) > 0):
+            active_reservations = {reservation.id: reservation for reservation in traci.person.getTaxiReservations(ReservationStates.any_state.value)}
+            picked_up_ids = {reservation_id for reservation_id, reservation in active_reservations.items()
+                             if reservation.state == ReservationStates.picked_up.value}
+            for key in [key for key in pooling_deadlines if key[0] not in active_reservations]:
+                del pooling_deadlines[key]
+            busy_taxi_grid = PointGrid(idle_taxi_cell_size)
+            for state in (TaxiStates.pickup, TaxiStates.occupied, TaxiStates.pickup_occupied):
+                for taxi in fleet.in_state(state).values():
+                    if (fleet_snapshot.has_position(taxi.id)):
+                        busy_taxi_grid.insert(taxi.id, fleet_snapshot.position(taxi.id), taxi)
+
+        for _ in range(len(reservations_queue)):
+            reservation = reservations_queue.popleft()
+
+            # Fit the reservation into the stops of a taxi, and if none of them can take it
+            # within the bounds fall back to sending the nearest idle taxi which can reach it
+            taxi, insertion = dispatch_taxi_pooling(reservation, active_reservations, picked_up_ids, idle_taxi_grid, busy_taxi_grid)
+            pooled = taxi != None and taxi.id not in idle_taxis
+            if (taxi == None or not send_taxi(taxi, reservation, insertion.reservation_ids)):
+                taxi, insertion = dispatch_taxi_greedy(reservation, idle_taxis, idle_taxi_grid), None
+                pooled = False
+                if (taxi != None and not send_taxi(taxi, reservation)):
+                    continue
+
+            if (taxi != None):
+                step_dispatches += 1
+                if (pooled):
+                    step_pooled_dispatches += 1
+                telemetry.record_dispatch(traci.simulation.getTime() - reservation.reservationTime)
+                active_reservations[reservation.id] = reservation
+                if (insertion != None):
+                    for stop in insertion.stops:
+                        if (stop.reservation_id == reservation.id):
+                            pooling_deadlines[(reservation.id, stop.is_pickup)] = stop.deadline
+                else:
+                    set_pooling_deadlines(reservation, taxi)
+                if (taxi.id in idle_taxis):
+                    taxi_dispatched(taxi)
+            else:
+                if (verbose):
+                    print("No available taxi could reach reservation {} at time {}".format(reservation.id, traci.simulation.getTime()))
+                reservations_queue.append(reservation)
+    else:
+        # Each reservation is taken off the front of the queue once, and put
+        # back at the end to be tried again next step if no taxi was available
+        for _ in range(len(reservations_queue)):
+            reservation = reservations_queue.popleft()
+
+            # Decide which taxi to dispatch to reservation
+            if (dispatch_policy == 'first'):
+                taxi = dispatch_taxi_first(reservation, idle_taxis, idle_taxi_grid)
+            else:
+                taxi = dispatch_taxi_greedy(reservation, idle_taxis, idle_taxi_grid)
+
+            # Actually dispatch that taxi
+            if (taxi != None):
+                if (send_taxi(taxi, reservation)):
+                    step_dispatches += 1
+                    telemetry.record_dispatch(traci.simulation.getTime() - reservation.reservationTime)
+                    taxi_dispatched(taxi)
             else:
-                taxi.unreachable_reservations_count += 1
-                # Remove taxis which weren't able to reach reservations 10 times
-                # as they are probably in some weird spot of the network
-                if (taxi.unreachable_reservations_count > 10):
-                    idle_taxis.remove(taxi)
-                    replace_taxi(taxi)
+                if (verbose):
+                    print("No available taxi could reach reservation {} at time {}".format(reservation.id, traci.simulation.getTime()))
+                reservations_queue.append(reservation)
 
-    return closest_taxi[1]
+    return step_dispatches, step_pooled_dispatches
 
 
 # Entrypoint of code
 def run():
 
     global drivable_edges
-    global taxis
     global taxi_group_buffers
+    global fleet_snapshot
+    global idle_taxi_grid
+    global router
+    global route_cache
 
     # Retrieve data
-    trips: List[Trip] = retrieve('../temp/trips.pkl')
-    drivable_edges = retrieve('../temp/drivable_edges.pkl')
-    simulation: Simulation = retrieve('../temp/simulation.pkl')
+    trips: Iterator[Trip] = retrieve_iter('../temp/trips.pkl')
+    drivable_edges = sorted(retrieve('../temp/drivable_edges.pkl'))
+    simulation: Simulation = retrieve('../temp/demand_simulation.pkl')
+    if (not route_with_sumo):
+        network: Network = retrieve('../temp/edges.bin')
+        router = Router(network, 'taxi')
 
     # Generate trips file
-    generate_trips_file(trips, simulation)
+    taxi_routes_file = generate_trips_file(trips, simulation)
 
     # Generate sumo config file and start simulation
-    generate_config(simulation.net_file, simulation.taxi_routes_file, simulation.start_time, simulation.end_time, '../temp/taxi.sumocfg', True)
+    period = dispatch_period if dispatch_policy == 'batch' else 1
+    generate_config(simulation.net_file, taxi_routes_file, simulation.start_time, simulation.end_time, '../temp/' + policy_file_name('taxi.sumocfg'), True, period)
     sumoBinary = checkBinary('sumo')
     traci.start([sumoBinary, 
-                '--configuration-file', '../temp/taxi.sumocfg',
-                '--tripinfo-output', '../temp/taxi.tripinfo.xml'])
-    simulation_log: List[TaxiSimulationLog] = []
-
-    # Add taxis to simulation
-    taxi_count = 100
-    for taxi in range(taxi_count):
-        new_taxi()
-
-    # Orchestrate simulation
-    reservations_queue = []
-    total_reservations = 0
-    total_dispatches = 0
-    idle_taxi_counts = []
-    reservation_queue_counts = []
-
-    for _ in tqdm(range(simulation.start_time, simulation.end_time+1200)):
-
-        # Move to next simulation step
-        traci.simulationStep()
-
-        if (traci.simulation.getTime()%120 == 0):
-            # Remove taxis from our list that have mysteriously disapeared
-            taxis = [taxi for taxi in taxis if taxi.id in traci.vehicle.getTaxiFleet(TaxiStates.any_state.value)]
-
-            # Store simulation logs
-            simulation_log.append(TaxiSimulationLog(
-                traci.simulation.getTime(),
-                len(taxis),
-                total_reservations,
-                total_dispatches,
-                sum(idle_taxi_counts)/len(idle_taxi_counts)
-            ))
-
-            # Print out info
-            if (verbose):
-                print("Total reservations: {} and total dispatches: {}".format(total_reservations, total_dispatches))
-                print("Total taxis: {}".format(len(taxis)))
-                print("Idle taxis average: {}".format(sum(idle_taxi_counts)/len(idle_taxi_counts)))
-                print("Reservation queue average: {}".format(sum(reservation_queue_counts)/len(reservation_queue_counts)))
-
-            # Reset stuff
-            idle_taxi_counts = []
-            reservation_queue_counts = []
-
-        # Get new reservations
-        new_reservations = list(traci.person.getTaxiReservations(ReservationStates.new.value))
-        reservations_queue.extend(new_reservations)
-        total_reservations += len(new_reservations)
-        reservation_queue_counts.append(len(reservations_queue))
-        
-        # Get list of idle taxis
-        idle_taxi_ids = traci.vehicle.getTaxiFleet(TaxiStates.idle.value)
-        idle_taxis = [taxi for taxi in taxis if taxi.id in idle_taxi_ids]
-        idle_taxi_counts.append(len(idle_taxis))
-
-        # Deal with queue of reservations
-        for reservation in reservations_queue:
-
-            # Decide which taxi to dispatch to reservation
-            taxi = dispatch_taxi_greedy(reservation, idle_taxis)
-            
-            # Actually dispatch that taxi
-            if (taxi != None):
-                try:
-                    taxi.pickup = [reservation.id, reservation.id]
-                    traci.vehicle.dispatchTaxi(taxi.id, taxi.pickup)
-                    if (verbose):
-                        print('Dispatched taxi {} for reservation {}'.format(taxi.id, reservation.id))
-                    total_dispatches += 1
-                    reservations_queue.remove(reservation)
-                    idle_taxis.remove(taxi)
-                except:
-                    if (verbose):
-                        print("Failed to dispatch taxi {} for reservation {} at time {}".format(taxi.id, reservation.id, traci.simulation.getTime()))
-                    reservations_queue.remove(reservation)
-            else:
+                '--configuration-file', '../temp/' + policy_file_name('taxi.sumocfg'),
+                '--tripinfo-output', '../temp/' + policy_file_name('taxi.tripinfo.xml')])
+    with TelemetrySink('../temp/' + policy_file_name('taxi_telemetry.csv'), '../temp/' + policy_file_name('taxi_simulation_log.pkl'),
+                       '../temp/' + policy_file_name('taxi_dispatch_log.pkl')) as telemetry:
+        fleet_snapshot = FleetSnapshot(traci)
+        idle_taxi_grid = PointGrid(idle_taxi_cell_size)
+        if (route_with_sumo):
+            route_cache = RouteCache(traci.simulation.findRoute, route_cache_size, route_cache_ttl, unreachable_route_cache_ttl)
+        else:
+            route_cache = RouteCache(find_route, route_cache_size)
+
+        # Add taxis to simulation
+        taxi_count = 100
+        for taxi in range(taxi_count):
+            new_taxi()
+
+        # Orchestrate simulation
+        reservations_queue = deque()
+        total_reservations = 0
+        total_dispatches = 0
+        total_pooled_dispatches = 0
+
+        for _ in tqdm(range(simulation.start_time, simulation.end_time+1200)):
+
+            # Move to next simulation step
+            traci.simulationStep()
+            idle_taxis = update_fleet()
+            route_cache.set_time(traci.simulation.getTime())
+
+            if (traci.simulation.getTime()%120 == 0):
+                # Write out simulation logs of the last window and start a new one
+                average_idle_taxi_count = telemetry.idle_taxi_counts.mean
+                average_queue_length = telemetry.queue_lengths.mean
+                window = telemetry.end_window(TaxiSimulationLog(
+                    traci.simulation.getTime(),
+                    len(fleet),
+                    total_reservations,
+                    total_dispatches,
+                    average_idle_taxi_count,
+                    fleet_vkt()
+                ))
+
+                # Print out info
                 if (verbose):
-                    print("No available taxi could reach reservation {} at time {}".format(reservation.id, traci.simulation.getTime()))
-                reservations_queue.remove(reservation)
-
-        # Update number of taxis in simulation
-        if (len(idle_taxis) < 10):
-            for i in range(max(50, len(reservations_queue))):
-                new_taxi()
-        if (len(idle_taxis) > 100):
-            taxi = random.choice(idle_taxis)
-            taxis.remove(taxi)
-            traci.vehicle.remove(taxi.id)
-            idle_taxis.remove(taxi)
-
-    # End simulation
-    traci.close()
-
-    store(simulation_log, '../temp/taxi_simulation_log.pkl')
+                    print("Total reservations: {} and total dispatches: {}".format(total_reservations, total_dispatches))
+                    if (dispatch_policy == 'pooling'):
+                        print("Pooled dispatches: {}".format(total_pooled_dispatches))
+                    print("Total taxis: {}".format(len(fleet)))
+                    print("Idle taxis average: {}".format(average_idle_taxi_count))
+                    print("Reservation queue average: {}".format(average_queue_length))
+                    print("Dispatch latency average: {:.1f} s".format(window['dispatch_latency_mean']))
+                    print("Dispatch time average: {:.2f} ms".format(1000*window['solve_time_mean']))
+                    print(route_cache.stats())
+
+            # Get new reservations
+            new_reservations = list(traci.person.getTaxiReservations(ReservationStates.new.value))
+            reservations_queue.extend(new_reservations)
+            total_reservations += len(new_reservations)
+            telemetry.record_step(len(idle_taxis), len(reservations_queue))
+
+            # Deal with queue of reservations
+            dispatch_start = time.perf_counter()
+            queued_reservation_count = len(reservations_queue)
+            queued_idle_taxi_count = len(idle_taxis)
+            step_dispatches, step_pooled_dispatches = dispatch_reservations(reservations_queue, idle_taxis, telemetry, period)
+            total_pooled_dispatches += step_pooled_dispatches
+            total_dispatches += step_dispatches
+
+            if (queued_reservation_count > 0):
+                telemetry.record_dispatch_log(DispatchLog(
+                    traci.simulation.getTime(),
+                    dispatch_policy,
+                    queued_reservation_count,
+                    queued_idle_taxi_count,
+                    step_dispatches,
+                    time.perf_counter() - dispatch_start
+                ))
+
+            # Update number of taxis in simulation
+            if (len(idle_taxis) < 10):
+                for i in range(max(50, len(reservations_queue))):
+                    new_taxi()
+            if (len(idle_taxis) > 100):
+                taxi = random.choice(list(idle_taxis.values()))
+                remove_taxi(taxi)
+
+        # End simulation
+        total_vkt = fleet_vkt()
+        traci.close()
+    print(route_cache.stats())
+    print('Fleet drove {:.1f} vehicle km with the {} dispatch policy, {} of {} dispatches pooled'.format(
+        total_vkt, dispatch_policy, total_pooled_dispatches, total_dispatches))
+
+    # Taxi rides are measured in passenger km, the distance driven by the fleet comes from the simulation logs
+    ride_infos = read_ride_infos('../temp/' + policy_file_name('taxi.tripinfo.xml'))
+    simulation_logs = list(retrieve_iter('../temp/' + policy_file_name('taxi_simulation_log.pkl')))
+    store_trip_infos(ride_infos, '../temp/' + policy_file_name('taxi.tripinfo.npz'), compute_kpis(ride_infos, simulation_logs))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the taxi simulation')
+    add_backend_argument(parser)
+    parser.add_argument('--dispatch-policy', choices=dispatch_policies, default=dispatch_policy,
+                        help='how taxis are dispatched to reservations, defaults to {}'.format(dispatch_policy))
+    args = parser.parse_args()
+    traci = load_backend(args.backend)
+    dispatch_policy = args.dispatch_policy
     run()
\ No newline at end of file
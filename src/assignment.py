@@ -0,0 +1,56 @@
+from typing import Tuple
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from spatial import PointGrid
+
+
+# Cost of pairs which must not be matched, larger than any distance in a city
+unmatched_cost = 1e12
+
+
+# Straight line distance between every point of a and every point of b
+def distance_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    return np.hypot(a[:, 0, None] - b[None, :, 0], a[:, 1, None] - b[None, :, 1])
+
+# Match rows to columns minimising the total cost, pairs which cost
+# unmatched_cost are left out so some rows may stay unmatched
+def match(costs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    rows, columns = linear_sum_assignment(costs)
+    matched = costs[rows, columns] < unmatched_cost
+    return rows[matched], columns[matched]
+
+# Assign taxis to requests minimising the total distance between them, returns
+# the indices of the matched requests and of their taxis. If k is given, each
+# request may only be matched to one of the k taxis nearest to it, so that the
+# cost matrix only has a column for each taxi near to some request
+def assign(request_points: np.ndarray, taxi_points: np.ndarray, k: int = None,
+           cell_size: float = 500) -> Tuple[np.ndarray, np.ndarray]:
+    request_points = np.asarray(request_points, dtype=np.float64).reshape(-1, 2)
+    taxi_points = np.asarray(taxi_points, dtype=np.float64).reshape(-1, 2)
+    if (len(request_points) == 0 or len(taxi_points) == 0):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    if (k == None or k >= len(taxi_points)):
+        return match(distance_matrix(request_points, taxi_points))
+
+    taxi_grid = PointGrid(cell_size)
+    for taxi_index, taxi_point in enumerate(taxi_points.tolist()):
+        taxi_grid.insert(taxi_index, taxi_point, taxi_index)
+    candidates = [
+        [taxi_index for _, taxi_index in taxi_grid.nearest(request_point, k)]
+        for request_point in request_points.tolist()
+    ]
+
+    columns = np.unique(np.concatenate([np.array(taxi_indices, dtype=np.int64) for taxi_indices in candidates]))
+    column_indices = {taxi_index: column for column, taxi_index in enumerate(columns.tolist())}
+    costs = np.full((len(request_points), len(columns)), unmatched_cost)
+    for request_index, taxi_indices in enumerate(candidates):
+        candidate_columns = [column_indices[taxi_index] for taxi_index in taxi_indices]
+        costs[request_index, candidate_columns] = distance_matrix(request_points[request_index], taxi_points[taxi_indices])[0]
+
+    request_indices, matched_columns = match(costs)
+    return request_indices, columns[matched_columns]
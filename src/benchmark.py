@@ -0,0 +1,150 @@
+from typing import List, Sequence
+import os
+import sys
+import time
+
+import numpy as np
+
+from datatypes import Edge, CountPoint, TaxiSimulationLog
+from utilities import retrieve, retrieve_iter
+from spatial import LaneGrid, closest_lane_brute_force, pack_lane_segments, closest_lanes
+
+
+# Compare checking every lane against the lane grid when finding the closest
+# lane of each count point, using the network built by 1-prepare_data.py
+def benchmark_lane_snapping(max_dist: float = 10):
+    edges: List[Edge] = retrieve('../temp/edges.pkl')
+    count_points: List[CountPoint] = retrieve('../temp/count_points.pkl')
+
+    start = time.perf_counter()
+    brute_force_lanes = [closest_lane_brute_force(edges, count_point) for count_point in count_points]
+    brute_force_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lane_grid = LaneGrid(edges)
+    grid_build_time = time.perf_counter() - start
+    grid_lanes = [lane_grid.closest_lane(count_point, max_dist) for count_point in count_points]
+    grid_time = time.perf_counter() - start
+
+    points = np.array([count_point.utm[:2] for count_point in count_points])
+
+    start = time.perf_counter()
+    segments, segment_lanes = pack_lane_segments(lane_grid.lanes)
+    kernel_lanes = closest_lanes(points, segments, segment_lanes)
+    kernel_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_lanes = lane_grid.closest_lanes(points, max_dist)
+    batch_time = time.perf_counter() - start
+
+    # Both must agree on every count point which is kept
+    mismatches = 0
+    for i, (brute_force_lane, grid_lane) in enumerate(zip(brute_force_lanes, grid_lanes)):
+        kernel_lane = lane_grid.lanes[kernel_lanes[0][i]]
+        if (kernel_lane.id != brute_force_lane[1].id or not np.isclose(kernel_lanes[1][i], brute_force_lane[0])):
+            mismatches += 1
+        if (brute_force_lane[0] < max_dist):
+            batch_lane = lane_grid.lanes[batch_lanes[0][i]] if batch_lanes[0][i] != -1 else None
+            if (grid_lane[0] != brute_force_lane[0] or grid_lane[1].id != brute_force_lane[1].id):
+                mismatches += 1
+            if (batch_lane == None or batch_lane.id != brute_force_lane[1].id or not np.isclose(batch_lanes[1][i], brute_force_lane[0])):
+                mismatches += 1
+        elif (grid_lane[1] != None or batch_lanes[0][i] != -1):
+            mismatches += 1
+
+    print('{} count points, {} edges'.format(len(count_points), len(edges)))
+    print('Brute force: {:.3f}s'.format(brute_force_time))
+    print('Lane grid: {:.3f}s ({:.3f}s to build)'.format(grid_time, grid_build_time))
+    print('Vectorised kernel: {:.3f}s'.format(kernel_time))
+    print('Vectorised kernel on lane grid: {:.3f}s'.format(batch_time))
+    print('Speedup: {:.1f}x'.format(brute_force_time/(grid_build_time+batch_time)))
+    print('Mismatches: {}'.format(mismatches))
+
+    return mismatches == 0
+
+
+# Compare how many steps per second each SUMO backend runs the base scenario
+# written by 3-run_base_simulation.py, reading the position and road of every
+# vehicle each step as the taxi dispatch loop does for its fleet
+def benchmark_backends(steps: int = 3600):
+    # Imported here as it needs SUMO, which the other benchmarks don't
+    from sumo_backend import checkBinary, load_backend, backend_names
+
+    for name in backend_names:
+        backend = load_backend(name)
+        if (backend.__name__ != name):
+            print('{}: not available'.format(name))
+            continue
+
+        backend.start([checkBinary('sumo'), '--configuration-file', '../temp/base.sumocfg',
+                       '--no-step-log', 'true', '--no-warnings', 'true'])
+        queries = 0
+        start = time.perf_counter()
+        for _ in range(steps):
+            backend.simulationStep()
+            for vehicle_id in backend.vehicle.getIDList():
+                backend.vehicle.getPosition(vehicle_id)
+                backend.vehicle.getRoadID(vehicle_id)
+                queries += 2
+        elapsed = time.perf_counter() - start
+        backend.close()
+
+        print('{}: {:.1f} steps/s, {:.0f} queries/s over {} steps'.format(name, steps/elapsed, queries/elapsed, steps))
+
+    return True
+
+
+# Compare the fleet size and the distance driven by the fleet in the peak hour between
+# runs of 4-run_taxi_simulation.py with each dispatch policy, the peak hour being the
+# one in which the most trips started in the run of the first policy. The fleet size
+# is the largest number of taxis in the simulation logs of the hour
+def benchmark_dispatch_policies(policies: Sequence[str] = ('greedy', 'pooling')):
+    from tripinfo import retrieve_trip_infos
+
+    runs = []
+    for policy in policies:
+        kpis_path = '../temp/taxi_{}.tripinfo.npz'.format(policy)
+        if (not os.path.exists(kpis_path)):
+            print('{}: no run found, run 4-run_taxi_simulation.py --dispatch-policy {} first'.format(policy, policy))
+            return False
+        logs: List[TaxiSimulationLog] = list(retrieve_iter('../temp/taxi_{}_simulation_log.pkl'.format(policy)))
+        runs.append((policy, retrieve_trip_infos(kpis_path)[1], logs))
+
+    first_kpis = runs[0][1]
+    peak_hour = int(first_kpis.hours[np.argmax(first_kpis.trip_counts)])
+    print('Peak hour: {}:00 to {}:00'.format(peak_hour, peak_hour+1))
+
+    first_fleet_size, first_vkt = None, None
+    for policy, kpis, logs in runs:
+        fleet_size = max((log.taxi_count for log in logs if log.time_step // 3600 == peak_hour), default=0)
+        hour_indices = np.flatnonzero(kpis.hours == peak_hour)
+        trip_count = int(kpis.trip_counts[hour_indices[0]]) if len(hour_indices) > 0 else 0
+        vkt = float(kpis.vkt[hour_indices[0]]) if len(hour_indices) > 0 else 0.0
+        print('{}: {} trips, fleet of {} taxis, {:.1f} vehicle km in the peak hour, {:.1f} vehicle km in total'.format(
+            policy, trip_count, fleet_size, vkt, kpis.total_vkt))
+        if (first_fleet_size == None):
+            first_fleet_size, first_vkt = fleet_size, vkt
+        elif (first_fleet_size > 0 and first_vkt > 0):
+            print('{} against {}: {:+.1f}% fleet size, {:+.1f}% vehicle km in the peak hour'.format(
+                policy, policies[0], 100*(fleet_size/first_fleet_size - 1), 100*(vkt/first_vkt - 1)))
+
+    return True
+
+
+benchmarks = {
+    'lane_snapping': benchmark_lane_snapping,
+    'backends': benchmark_backends,
+    'dispatch_policies': benchmark_dispatch_policies,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+    for name in names:
+        if (name not in benchmarks):
+            sys.exit('Unknown benchmark {}, choose from {}'.format(name, ', '.join(benchmarks)))
+    success = True
+    for name in names:
+        print('--{}--'.format(name.upper()))
+        success = benchmarks[name]() and success
+    if (not success):
+        sys.exit(1)
@@ -66,6 +66,7 @@ class Simulation:
     net_file: str
     base_routes_file: str
     taxi_routes_file: str
+    seed: int = 0
 
 @dataclass
 class Trip:
@@ -106,6 +107,16 @@ class TaxiSimulationLog:
     reservation_count: int
     dispatch_count: int
     average_idle_taxi_count: float
+    fleet_vkt: float = 0.0
+
+@dataclass
+class DispatchLog:
+    time_step: float
+    policy: str
+    reservation_count: int
+    idle_taxi_count: int
+    dispatch_count: int
+    solve_time: float
 
 class P(Enum):
     count_point_id = 0
@@ -0,0 +1,151 @@
+from typing import Dict, List, Set, Tuple
+
+from datatypes import TaxiStates, Taxi
+from sumo_backend import tc
+
+
+# States a taxi can be in, excluding TaxiStates.any_state
+taxi_states = [TaxiStates.idle, TaxiStates.pickup, TaxiStates.occupied, TaxiStates.pickup_occupied]
+
+
+# State of every taxi of the fleet as of the last simulation step. Positions, roads
+# and distances driven come from variable subscriptions, which SUMO sends all at once after each
+# step, so reading them doesn't need a call to SUMO for every taxi
+class FleetSnapshot:
+
+    subscribed_variables = (tc.VAR_POSITION, tc.VAR_ROAD_ID, tc.VAR_DISTANCE)
+
+    def __init__(self, traci):
+        self.traci = traci
+
+        # Taxis added to the simulation which haven't departed yet, SUMO only
+        # accepts subscriptions to vehicles once they are in the network
+        self.pending_ids: Set[str] = set()
+        self.subscribed_ids: Set[str] = set()
+
+        self.results: Dict[str, dict] = {}
+        self.state_ids: Dict[TaxiStates, Set[str]] = {state: set() for state in taxi_states}
+
+        # Taxis which left the simulation during the last step without being removed
+        self.vanished_ids: Set[str] = set()
+        # Distance driven by the vanished taxis as of the step before
+        self.vanished_distances: Dict[str, float] = {}
+
+    # Start following a taxi which has just been added to the simulation
+    def add(self, taxi_id: str):
+        self.pending_ids.add(taxi_id)
+
+    # Stop following a taxi, must be called before it is removed from the simulation
+    def remove(self, taxi_id: str):
+        if (taxi_id in self.subscribed_ids):
+            self.traci.vehicle.unsubscribe(taxi_id)
+            self.subscribed_ids.discard(taxi_id)
+        self.pending_ids.discard(taxi_id)
+        self.results.pop(taxi_id, None)
+        for state_ids in self.state_ids.values():
+            state_ids.discard(taxi_id)
+
+    # Read the state of the fleet after a simulation step
+    def refresh(self):
+        departed_ids = self.pending_ids.intersection(self.traci.simulation.getDepartedIDList())
+        for taxi_id in departed_ids:
+            self.traci.vehicle.subscribe(taxi_id, self.subscribed_variables)
+        self.pending_ids -= departed_ids
+        self.subscribed_ids |= departed_ids
+
+        # Taxis which have left the simulation have no results. traci clears and refills
+        # the same dict every step, so a copy is kept to still have the last step's
+        # results of taxis which vanished, and so that removing a taxi doesn't change it
+        previous_results = self.results
+        self.results = dict(self.traci.vehicle.getAllSubscriptionResults())
+        self.vanished_ids = self.subscribed_ids.difference(self.results.keys())
+        self.vanished_distances = {taxi_id: previous_results[taxi_id][tc.VAR_DISTANCE]
+                                   for taxi_id in self.vanished_ids if taxi_id in previous_results}
+        self.subscribed_ids -= self.vanished_ids
+
+        # Taxis in state pickup_occupied are also listed by SUMO as both in pickup and occupied,
+        # so each taxi is put in the most specific state it is listed in
+        fleet_ids = {state: set(self.traci.vehicle.getTaxiFleet(state.value)) for state in taxi_states}
+        pickup_occupied_ids = fleet_ids[TaxiStates.pickup_occupied]
+        self.state_ids = {
+            TaxiStates.idle: fleet_ids[TaxiStates.idle],
+            TaxiStates.pickup: fleet_ids[TaxiStates.pickup] - pickup_occupied_ids,
+            TaxiStates.occupied: fleet_ids[TaxiStates.occupied] - pickup_occupied_ids,
+            TaxiStates.pickup_occupied: pickup_occupied_ids
+        }
+
+    def has_position(self, taxi_id: str) -> bool:
+        return taxi_id in self.results
+
+    def position(self, taxi_id: str) -> Tuple[float, float]:
+        return self.results[taxi_id][tc.VAR_POSITION]
+
+    def road_id(self, taxi_id: str) -> str:
+        return self.results[taxi_id][tc.VAR_ROAD_ID]
+
+    # Distance in metres driven by a taxi since it departed
+    def distance(self, taxi_id: str) -> float:
+        return self.results[taxi_id][tc.VAR_DISTANCE]
+
+
+# Taxis of the fleet by id, along with the taxis in each state. The taxis of a state
+# are kept across steps and only the taxis whose state changed are moved, so apart
+# from comparing with the sets read from SUMO, which is done by the set operations
+# themselves, keeping track of the fleet takes time in proportion to the changes
+class FleetRegistry:
+
+    def __init__(self):
+        self.taxis: Dict[str, Taxi] = {}
+        self.states: Dict[str, TaxiStates] = {}
+        self.state_taxis: Dict[TaxiStates, Dict[str, Taxi]] = {state: {} for state in taxi_states}
+        # Order in which taxis were added, so that changes are always applied in the same order
+        self.order: Dict[str, int] = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.taxis)
+
+    def __contains__(self, taxi_id: str):
+        return taxi_id in self.taxis
+
+    def __getitem__(self, taxi_id: str) -> Taxi:
+        return self.taxis[taxi_id]
+
+    def add(self, taxi: Taxi):
+        self.taxis[taxi.id] = taxi
+        self.order[taxi.id] = self.counter
+        self.counter += 1
+
+    def remove(self, taxi_id: str):
+        del self.taxis[taxi_id]
+        del self.order[taxi_id]
+        state = self.states.pop(taxi_id, None)
+        if (state != None):
+            del self.state_taxis[state][taxi_id]
+
+    def set_state(self, taxi_id: str, state: TaxiStates):
+        previous_state = self.states.get(taxi_id)
+        if (previous_state == state):
+            return
+        if (previous_state != None):
+            del self.state_taxis[previous_state][taxi_id]
+        self.states[taxi_id] = state
+        self.state_taxis[state][taxi_id] = self.taxis[taxi_id]
+
+    # Bring the states in line with those seen by the snapshot in the last step,
+    # returns the taxis which left the simulation without being removed
+    def update(self, snapshot: FleetSnapshot) -> List[Taxi]:
+        vanished_ids = sorted((taxi_id for taxi_id in snapshot.vanished_ids if taxi_id in self.taxis), key=self.order.__getitem__)
+        vanished_taxis = [self.taxis[taxi_id] for taxi_id in vanished_ids]
+        for taxi in vanished_taxis:
+            self.remove(taxi.id)
+        for state in taxi_states:
+            changed_ids = [taxi_id for taxi_id in snapshot.state_ids[state].difference(self.state_taxis[state]) if taxi_id in self.taxis]
+            for taxi_id in sorted(changed_ids, key=self.order.__getitem__):
+                self.set_state(taxi_id, state)
+        return vanished_taxis
+
+    # Get the taxis in a state by id, in the order they entered it. This is the
+    # dict kept by the registry, so it must not be changed by the caller
+    def in_state(self, state: TaxiStates) -> Dict[str, Taxi]:
+        return self.state_taxis[state]
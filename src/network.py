@@ -0,0 +1,449 @@
+from typing import Dict, List, Sequence, Tuple
+from array import array
+import json
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from tqdm import tqdm
+
+from datatypes import Lane, Edge
+
+
+# Normalise coordinates of shape
+def normalise_shape(shape_str, origin):
+    shape = [list(map(float, point.split(","))) for point in shape_str.split(" ")]
+    for point in shape:
+        point[0] += origin[0]
+        point[1] += origin[1]
+
+    return shape
+
+# Check whether vehicles of the given class may use a lane, lanes
+# without allow or disallow attributes are open to every class
+def lane_allows(allow: List[str], disallow: List[str], vclass: str) -> bool:
+    if (allow):
+        return vclass in allow or 'all' in allow
+    return vclass not in disallow and 'all' not in disallow
+
+# An edge is drivable if one of its lanes allows passenger cars
+def lane_is_drivable(allow: List[str], disallow: List[str]) -> bool:
+    if (allow and 'passenger' in allow):
+        return True
+    elif (disallow and 'passenger' not in disallow):
+        return True
+    return False
+
+
+# Sequence of strings stored as utf-8 bytes one after the other,
+# string i is blob[offsets[i]:offsets[i+1]]
+class StringTable(Sequence):
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    @staticmethod
+    def from_strings(strings: List[str]) -> 'StringTable':
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return StringTable(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if (index < 0):
+            index += len(self)
+        if (not 0 <= index < len(self)):
+            raise IndexError('string table index out of range')
+        start, end = self.offsets[index:index+2]
+        return self.blob[start:end].tobytes().decode('utf-8')
+
+
+# Read only view of a lane stored in a Network, pickles as a Lane
+class LaneView:
+    __slots__ = ('network', 'index')
+
+    def __init__(self, network: 'Network', index: int):
+        self.network = network
+        self.index = index
+
+    @property
+    def id(self) -> str:
+        return self.network.lane_ids[self.index]
+
+    @property
+    def speed(self) -> float:
+        return float(self.network.lane_speeds[self.index])
+
+    @property
+    def shape(self) -> List[List[float]]:
+        return self.network.lane_shape(self.index).tolist()
+
+    @property
+    def allow(self) -> List[str]:
+        allow = self.network.lane_allow[self.index]
+        return allow.split(' ') if allow else []
+
+    @property
+    def disallow(self) -> List[str]:
+        disallow = self.network.lane_disallow[self.index]
+        return disallow.split(' ') if disallow else []
+
+    def to_lane(self) -> Lane:
+        return Lane(self.id, self.speed, self.shape, self.allow, self.disallow)
+
+    def __reduce__(self):
+        return (Lane, (self.id, self.speed, self.shape, self.allow, self.disallow))
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return 'LaneView(id={!r}, speed={!r})'.format(self.id, self.speed)
+
+# Read only view of an edge stored in a Network, pickles as an Edge
+class EdgeView:
+    __slots__ = ('network', 'index')
+
+    def __init__(self, network: 'Network', index: int):
+        self.network = network
+        self.index = index
+
+    @property
+    def id(self) -> str:
+        return self.network.edge_ids[self.index]
+
+    @property
+    def is_drivable(self) -> bool:
+        return bool(self.network.edge_drivable[self.index])
+
+    @property
+    def lanes(self) -> List[LaneView]:
+        start, end = self.network.edge_lane_offsets[self.index:self.index+2]
+        return [LaneView(self.network, lane_index) for lane_index in range(start, end)]
+
+    def to_edge(self) -> Edge:
+        return Edge(self.id, self.is_drivable, [lane.to_lane() for lane in self.lanes])
+
+    def __reduce__(self):
+        return (Edge, (self.id, self.is_drivable, self.lanes))
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return 'EdgeView(id={!r}, is_drivable={!r})'.format(self.id, self.is_drivable)
+
+
+# SUMO network with the geometry of all lanes stored in flat arrays, lane i
+# has the points coords[lane_shape_offsets[i]:lane_shape_offsets[i+1]] and
+# edge i has the lanes edge_lane_offsets[i] up to edge_lane_offsets[i+1].
+# Connection i goes from lane connection_from_lanes[i] to connection_to_lanes[i]
+class Network:
+
+    def __init__(self, origin: Tuple[float, float], utm_zone: int,
+                 edge_ids: List[str], edge_drivable: np.ndarray, edge_lane_offsets: np.ndarray,
+                 lane_ids: List[str], lane_speeds: np.ndarray, lane_allow: List[str], lane_disallow: List[str],
+                 lane_shape_offsets: np.ndarray, coords: np.ndarray,
+                 connection_from_lanes: np.ndarray = None, connection_to_lanes: np.ndarray = None):
+        self.origin = origin
+        self.utm_zone = utm_zone
+        self.edge_ids = edge_ids
+        self.edge_drivable = edge_drivable
+        self.edge_lane_offsets = edge_lane_offsets
+        self.lane_ids = lane_ids
+        self.lane_speeds = lane_speeds
+        self.lane_allow = lane_allow
+        self.lane_disallow = lane_disallow
+        self.lane_shape_offsets = lane_shape_offsets
+        self.coords = coords
+        self.connection_from_lanes = connection_from_lanes if connection_from_lanes is not None else np.empty(0, dtype=np.int64)
+        self.connection_to_lanes = connection_to_lanes if connection_to_lanes is not None else np.empty(0, dtype=np.int64)
+        self._edge_indices: Dict[str, int] = None
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    # Get points of the shape of a lane as an array of (x, y) rows
+    def lane_shape(self, lane_index: int) -> np.ndarray:
+        start, end = self.lane_shape_offsets[lane_index:lane_index+2]
+        return self.coords[start:end]
+
+    def edges(self) -> List[EdgeView]:
+        return [EdgeView(self, edge_index) for edge_index in range(len(self.edge_ids))]
+
+    def lanes(self) -> List[LaneView]:
+        return [LaneView(self, lane_index) for lane_index in range(len(self.lane_ids))]
+
+    def edge_index(self, edge_id: str) -> int:
+        if (self._edge_indices == None):
+            self._edge_indices = {edge_id: edge_index for edge_index, edge_id in enumerate(self.edge_ids)}
+        return self._edge_indices[edge_id]
+
+    def edge(self, edge_id: str) -> EdgeView:
+        return EdgeView(self, self.edge_index(edge_id))
+
+    # Get index of the edge which each lane belongs to
+    def lane_edges(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.edge_ids)), np.diff(self.edge_lane_offsets))
+
+    # Get mask of the lanes which vehicles of the given class may use
+    def vclass_lanes(self, vclass: str) -> np.ndarray:
+        permissions: Dict[Tuple[str, str], bool] = {}
+        allowed = np.zeros(len(self.lane_ids), dtype=bool)
+        for lane_index in range(len(self.lane_ids)):
+            key = (self.lane_allow[lane_index], self.lane_disallow[lane_index])
+            if (key not in permissions):
+                permissions[key] = lane_allows(key[0].split(' ') if key[0] else [], key[1].split(' ') if key[1] else [], vclass)
+            allowed[lane_index] = permissions[key]
+        return allowed
+
+    def drivable_edge_ids(self) -> List[str]:
+        return [self.edge_ids[edge_index] for edge_index in np.flatnonzero(self.edge_drivable)]
+
+    # Pack the segments of all lanes into rows of (x1, y1, x2, y2), along
+    # with the index of the lane which each segment belongs to
+    def lane_segments(self) -> Tuple[np.ndarray, np.ndarray]:
+        point_lanes = np.repeat(np.arange(len(self.lane_ids)), np.diff(self.lane_shape_offsets))
+        # A segment joins two consecutive points of the same lane
+        is_segment = point_lanes[:-1] == point_lanes[1:]
+        segments = np.hstack((self.coords[:-1][is_segment], self.coords[1:][is_segment]))
+        return segments.reshape(-1, 4), point_lanes[:-1][is_segment]
+
+
+# Accumulates edges and lanes into the flat arrays of a Network
+class NetworkBuilder:
+
+    def __init__(self):
+        self.origin = None
+        self.utm_zone = None
+        self.edge_ids: List[str] = []
+        self.edge_drivable = array('b')
+        self.edge_lane_offsets = array('q', [0])
+        self.lane_ids: List[str] = []
+        self.lane_speeds = array('d')
+        self.lane_allow: List[str] = []
+        self.lane_disallow: List[str] = []
+        self.lane_shape_offsets = array('q', [0])
+        self.coords = array('d')
+        self.connection_from_lanes = array('q')
+        self.connection_to_lanes = array('q')
+        self.lane_indices: Dict[str, int] = {}
+
+        # Many lanes share the same permissions, so only keep one copy of each
+        self.permissions: Dict[str, str] = {}
+
+    def add_lane(self, lane_id: str, speed: float, shape: List[List[float]], allow: str, disallow: str):
+        self.lane_indices[lane_id] = len(self.lane_ids)
+        self.lane_ids.append(lane_id)
+        self.lane_speeds.append(speed)
+        self.lane_allow.append(self.permissions.setdefault(allow, allow))
+        self.lane_disallow.append(self.permissions.setdefault(disallow, disallow))
+        for point in shape:
+            self.coords.extend(point[:2])
+        self.lane_shape_offsets.append(len(self.coords)//2)
+
+    # Add edge made up of all lanes added since the previous edge
+    def add_edge(self, edge_id: str, is_drivable: bool):
+        self.edge_ids.append(edge_id)
+        self.edge_drivable.append(is_drivable)
+        self.edge_lane_offsets.append(len(self.lane_ids))
+
+    def add_connection(self, from_lane_id: str, to_lane_id: str):
+        if (from_lane_id in self.lane_indices and to_lane_id in self.lane_indices):
+            self.connection_from_lanes.append(self.lane_indices[from_lane_id])
+            self.connection_to_lanes.append(self.lane_indices[to_lane_id])
+
+    def build(self) -> Network:
+        return Network(
+            self.origin,
+            self.utm_zone,
+            self.edge_ids,
+            np.frombuffer(self.edge_drivable, dtype=np.int8).astype(bool),
+            np.frombuffer(self.edge_lane_offsets, dtype=np.int64),
+            self.lane_ids,
+            np.frombuffer(self.lane_speeds, dtype=np.float64),
+            self.lane_allow,
+            self.lane_disallow,
+            np.frombuffer(self.lane_shape_offsets, dtype=np.int64),
+            np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2),
+            np.frombuffer(self.connection_from_lanes, dtype=np.int64),
+            np.frombuffer(self.connection_to_lanes, dtype=np.int64)
+        )
+
+
+# Load SUMO network while streaming through the file, so that
+# the whole XML tree is never held in memory
+def load_network(path: str) -> Network:
+    builder = NetworkBuilder()
+
+    progress = tqdm(desc='Extracting lanes from network', unit=' edges')
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, element in context:
+        if (event == 'start'):
+            depth += 1
+            continue
+        depth -= 1
+        if (depth != 0):
+            continue
+
+        if (element.tag == 'location'):
+            # Get origin UTM position
+            temp1 = element.attrib['projParameter'].split(' ')
+            builder.utm_zone = int(temp1[1].split('=')[1])
+
+            origin = element.attrib['netOffset'].split(',')
+            builder.origin = [-1*float(coord) for coord in origin]
+
+        elif (element.tag == 'edge'):
+            is_drivable = False
+            for lane_element in element.findall('lane'):
+                allow = lane_element.attrib.get('allow', '')
+                disallow = lane_element.attrib.get('disallow', '')
+                builder.add_lane(
+                    lane_element.attrib['id'],
+                    float(lane_element.attrib['speed']),
+                    normalise_shape(lane_element.attrib['shape'], builder.origin),
+                    allow,
+                    disallow
+                )
+                if (lane_is_drivable(allow.split(' ') if allow else [], disallow.split(' ') if disallow else [])):
+                    is_drivable = True
+
+            builder.add_edge(element.attrib['id'], is_drivable)
+            progress.update()
+
+        # Connections from internal lanes are left out, as the connection
+        # between the two normal edges on either side of them is enough
+        elif (element.tag == 'connection' and not element.attrib['from'].startswith(':')):
+            builder.add_connection(
+                element.attrib['from'] + '_' + element.attrib['fromLane'],
+                element.attrib['to'] + '_' + element.attrib['toLane']
+            )
+
+        # Drop everything parsed so far
+        root.clear()
+
+    progress.close()
+
+    return builder.build()
+
+# Create network from a list of Edge objects, as stored in edges.pkl
+def network_from_edges(edges: List[Edge]) -> Network:
+    builder = NetworkBuilder()
+    for edge in edges:
+        for lane in edge.lanes:
+            builder.add_lane(lane.id, lane.speed, lane.shape, ' '.join(lane.allow), ' '.join(lane.disallow))
+        builder.add_edge(edge.id, edge.is_drivable)
+    return builder.build()
+
+
+# The network cache is a header describing each array followed by the arrays
+# themselves, each starting on an 8 byte boundary so they can be memory mapped
+NETWORK_CACHE_MAGIC = b'RTAXINET'
+NETWORK_CACHE_VERSION = 2
+
+# Store network in binary cache file
+def store_network(network: Network, path: str):
+    string_tables = {
+        'edge_ids': network.edge_ids,
+        'lane_ids': network.lane_ids,
+        'lane_allow': network.lane_allow,
+        'lane_disallow': network.lane_disallow
+    }
+    arrays = {
+        'edge_drivable': np.packbits(np.asarray(network.edge_drivable, dtype=bool)),
+        'edge_lane_offsets': np.asarray(network.edge_lane_offsets, dtype=np.int64),
+        'lane_speeds': np.asarray(network.lane_speeds, dtype=np.float64),
+        'lane_shape_offsets': np.asarray(network.lane_shape_offsets, dtype=np.int64),
+        'coords': np.asarray(network.coords, dtype=np.float64),
+        'connection_from_lanes': np.asarray(network.connection_from_lanes, dtype=np.int64),
+        'connection_to_lanes': np.asarray(network.connection_to_lanes, dtype=np.int64)
+    }
+    for name, strings in string_tables.items():
+        if (not isinstance(strings, StringTable)):
+            strings = StringTable.from_strings(list(strings))
+        arrays[name + '.offsets'] = np.asarray(strings.offsets, dtype=np.int64)
+        arrays[name + '.blob'] = np.asarray(strings.blob, dtype=np.uint8)
+
+    # Work out where each array goes once the header is written
+    sections = {}
+    offset = 0
+    for name, data in arrays.items():
+        sections[name] = {'offset': offset, 'dtype': data.dtype.str, 'shape': list(data.shape)}
+        offset += -(-data.nbytes // 8) * 8
+    header = json.dumps({
+        'version': NETWORK_CACHE_VERSION,
+        'origin': list(network.origin) if network.origin != None else None,
+        'utm_zone': network.utm_zone,
+        'edge_count': len(network.edge_ids),
+        'sections': sections
+    }).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as outp:
+        outp.write(NETWORK_CACHE_MAGIC)
+        outp.write(np.uint64(len(header)).tobytes())
+        outp.write(header)
+        for data in arrays.values():
+            outp.write(np.ascontiguousarray(data).tobytes())
+            outp.write(b'\0' * (-data.nbytes % 8))
+
+# Open binary cache file, the arrays of the returned network are memory mapped
+# so opening is quick and the pages are shared between processes
+def retrieve_network(path: str) -> Network:
+    with open(path, 'rb') as openfile:
+        if (openfile.read(len(NETWORK_CACHE_MAGIC)) != NETWORK_CACHE_MAGIC):
+            raise ValueError('{} is not a network cache file'.format(path))
+        header_length = int(np.frombuffer(openfile.read(8), dtype=np.uint64)[0])
+        header = json.loads(openfile.read(header_length).decode('utf-8'))
+    if (header['version'] != NETWORK_CACHE_VERSION):
+        raise ValueError('{} has network cache version {}, expected {}'.format(path, header['version'], NETWORK_CACHE_VERSION))
+
+    data_start = len(NETWORK_CACHE_MAGIC) + 8 + header_length
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, section in header['sections'].items():
+        dtype = np.dtype(section['dtype'])
+        start = data_start + section['offset']
+        count = int(np.prod(section['shape']))
+        arrays[name] = buffer[start:start+count*dtype.itemsize].view(dtype).reshape(section['shape'])
+
+    string_tables = {
+        name: StringTable(arrays[name + '.offsets'], arrays[name + '.blob'])
+        for name in ['edge_ids', 'lane_ids', 'lane_allow', 'lane_disallow']
+    }
+    return Network(
+        header['origin'],
+        header['utm_zone'],
+        string_tables['edge_ids'],
+        np.unpackbits(arrays['edge_drivable'], count=header['edge_count']).astype(bool),
+        arrays['edge_lane_offsets'],
+        string_tables['lane_ids'],
+        arrays['lane_speeds'],
+        string_tables['lane_allow'],
+        string_tables['lane_disallow'],
+        arrays['lane_shape_offsets'],
+        arrays['coords'],
+        arrays['connection_from_lanes'],
+        arrays['connection_to_lanes']
+    )
+
+if __name__ == '__main__':
+    from utilities import convert_edges_pickle
+    if (len(sys.argv) != 3):
+        sys.exit('usage: python3 network.py <edges.pkl> <edges.bin>')
+    convert_edges_pickle(sys.argv[1], sys.argv[2])
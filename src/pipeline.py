@@ -0,0 +1,188 @@
+from typing import Dict, List, Optional
+from dataclasses import dataclass, field
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from utilities import create_dir
+
+
+# A stage of the pipeline, along with the files it reads and writes. Parameters
+# such as net options, seeds and fleet sizes are set in the scripts themselves
+# or in simulation.pkl, so they are covered by the hashes of those files. Options
+# given to a script on the command line are its parameters, they are hashed into
+# the stage record as well, and outputs can name them, as in {dispatch_policy}, so
+# that runs with different parameters keep their own files. Each file is written by
+# a single stage, otherwise a later stage rewriting it would make the earlier one
+# look out of date on the next run
+@dataclass
+class Stage:
+    script: str
+    inputs: List[str]
+    outputs: List[str]
+    parameters: Dict[str, str] = field(default_factory=dict)
+
+# Modules shared by the stages, a change to any of them reruns every stage
+library_files = ['datatypes.py', 'utilities.py', 'network.py', 'spatial.py', 'sampling.py', 'routing.py', 'tripinfo.py',
+                 'sumo_backend.py', 'fleet.py', 'assignment.py',
+                 'telemetry.py', 'pooling.py']
+
+# Backend used by the stages which talk to SUMO, as picked by sumo_backend.py
+default_backend = os.environ.get('SUMO_BACKEND', 'traci')
+
+stages: List[Stage] = [
+    Stage('0-get_data.py',
+          ['local_authorities.geojson', 'city_populations.csv'],
+          ['../temp/osm_bbox.osm.xml', '../temp/simulation.pkl', '../temp/count_points.pkl']),
+    Stage('1-prepare_data.py',
+          ['../temp/osm_bbox.osm.xml', '../temp/simulation.pkl', '../temp/count_points.pkl'],
+          ['../temp/city.net.xml', '../temp/osm_taz.xml', '../temp/osm_taz_weight.csv', '../temp/tazs.pkl',
+           '../temp/taz_edges.pkl', '../temp/taz_travel_times.npz', '../temp/edges.pkl', '../temp/edges.bin',
+           '../temp/filtered_count_points.pkl', '../temp/drivable_edges.pkl']),
+    Stage('2-generate_demand.py',
+          ['../temp/filtered_count_points.pkl', '../temp/taz_edges.pkl', '../temp/edges.bin', '../temp/simulation.pkl',
+           '../temp/city.net.xml'],
+          ['../temp/trips.pkl', '../temp/demand_simulation.pkl']),
+    Stage('3-run_base_simulation.py',
+          ['../temp/trips.pkl', '../temp/demand_simulation.pkl', '../temp/city.net.xml'],
+          ['../temp/base.routes.xml', '../temp/base.tripinfo.xml', '../temp/base.tripinfo.npz']),
+    Stage('4-run_taxi_simulation.py',
+          ['../temp/trips.pkl', '../temp/drivable_edges.pkl', '../temp/demand_simulation.pkl', '../temp/edges.bin',
+           '../temp/city.net.xml'],
+          ['../temp/taxi_{dispatch_policy}.routes.xml', '../temp/taxi_{dispatch_policy}.sumocfg',
+           '../temp/taxi_{dispatch_policy}.tripinfo.xml', '../temp/taxi_{dispatch_policy}_simulation_log.pkl',
+           '../temp/taxi_{dispatch_policy}.tripinfo.npz', '../temp/taxi_{dispatch_policy}_dispatch_log.pkl',
+           '../temp/taxi_{dispatch_policy}_telemetry.csv'],
+          {'--backend': default_backend, '--dispatch-policy': 'greedy'}),
+]
+
+cache_path = '../temp/stage_cache.json'
+
+
+# Hashes files by content, remembering the hash of each file along with its size and
+# modification time so that files which haven't been touched aren't read again
+class FileHasher:
+
+    def __init__(self, known_hashes: Dict[str, list]):
+        self.known_hashes = known_hashes
+
+    def hash(self, path: str) -> Optional[str]:
+        if (not os.path.exists(path)):
+            return None
+
+        stat = os.stat(path)
+        known = self.known_hashes.get(path)
+        if (known != None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns):
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as openfile:
+            for chunk in iter(lambda: openfile.read(1 << 20), b''):
+                digest.update(chunk)
+        self.known_hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def hash_all(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        return {path: self.hash(path) for path in paths}
+
+
+def load_cache() -> dict:
+    if (not os.path.exists(cache_path)):
+        return {'files': {}, 'stages': {}}
+    with open(cache_path, 'r') as openfile:
+        return json.load(openfile)
+
+def save_cache(cache: dict):
+    with open(cache_path + '.part', 'w') as outp:
+        json.dump(cache, outp, indent=2)
+    os.replace(cache_path + '.part', cache_path)
+
+# Everything which decides what a stage produces
+def stage_inputs(stage: Stage) -> List[str]:
+    return [stage.script] + library_files + stage.inputs
+
+# Command line of a stage, its parameters are passed as options
+def stage_command(stage: Stage) -> List[str]:
+    command = [sys.executable, stage.script]
+    for option, value in stage.parameters.items():
+        command += [option, str(value)]
+    return command
+
+# Stages are recorded by their command line, so the record of a stage run
+# with some parameters is kept when it is run with others
+def stage_key(stage: Stage) -> str:
+    return ' '.join(stage_command(stage)[1:])
+
+# Files written by a stage, with the values of its parameters filled in
+def stage_outputs(stage: Stage) -> List[str]:
+    values = {option.lstrip('-').replace('-', '_'): value for option, value in stage.parameters.items()}
+    return [output.format(**values) for output in stage.outputs]
+
+def parameters_hash(stage: Stage) -> str:
+    return hashlib.sha256(json.dumps(stage.parameters, sort_keys=True).encode('utf-8')).hexdigest()
+
+# A stage can be skipped if it was last run with the same parameters, and
+# its inputs and outputs are exactly as they were after that run
+def stage_is_valid(stage: Stage, cache: dict, hasher: FileHasher) -> bool:
+    record = cache['stages'].get(stage_key(stage))
+    if (record == None or record.get('parameters') != parameters_hash(stage)):
+        return False
+    outputs = hasher.hash_all(stage_outputs(stage))
+    if (None in outputs.values() or outputs != record['outputs']):
+        return False
+    return hasher.hash_all(stage_inputs(stage)) == record['inputs']
+
+# Make sure no file is written by more than one stage
+def check_outputs():
+    writers: Dict[str, str] = {}
+    for stage in stages:
+        for output in stage_outputs(stage):
+            if (output in writers):
+                raise ValueError('{} is written by both {} and {}'.format(output, writers[output], stage.script))
+            writers[output] = stage.script
+
+# Give each stage which takes one of the options the value it was set to,
+# options which weren't set keep the value of the stage
+def set_parameters(parameters: Dict[str, Optional[str]]):
+    for stage in stages:
+        for option, value in parameters.items():
+            if (option in stage.parameters and value != None):
+                stage.parameters[option] = value
+
+# Run stages in order, skipping those whose outputs are still valid
+def run(force: bool = False):
+    check_outputs()
+    create_dir('../temp')
+    cache = load_cache()
+    hasher = FileHasher(cache['files'])
+
+    for stage in stages:
+        if (not force and stage_is_valid(stage, cache, hasher)):
+            print('--SKIPPING {}, inputs unchanged--'.format(stage.script))
+            continue
+
+        print('--RUNNING {}--'.format(stage_key(stage)))
+        cache['stages'].pop(stage_key(stage), None)
+        save_cache(cache)
+        subprocess.check_call(stage_command(stage))
+
+        # Inputs are hashed after the run, as stages may update files they read
+        cache['stages'][stage_key(stage)] = {
+            'parameters': parameters_hash(stage),
+            'inputs': hasher.hash_all(stage_inputs(stage)),
+            'outputs': hasher.hash_all(stage_outputs(stage))
+        }
+        save_cache(cache)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline, skipping stages whose inputs are unchanged')
+    parser.add_argument('--force', action='store_true', help='run every stage even if its outputs are valid')
+    parser.add_argument('--backend', default=None,
+                        help='how the stages talk to SUMO, defaults to $SUMO_BACKEND or traci')
+    parser.add_argument('--dispatch-policy', default=None, help='how the taxi simulation dispatches taxis')
+    args = parser.parse_args()
+    set_parameters({'--backend': args.backend, '--dispatch-policy': args.dispatch_policy})
+    run(args.force)
@@ -0,0 +1,143 @@
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from collections import Counter
+from dataclasses import dataclass, replace
+import math
+
+
+# Seconds a taxi stands at a stop, the defaults of the SUMO taxi device
+pickup_duration = 0
+dropoff_duration = 60
+
+
+# A stop a taxi makes to pick up or drop off the people of a reservation, the
+# deadline is the simulation time by which the taxi should get to the stop
+@dataclass
+class Stop:
+    reservation_id: str
+    edge_id: str
+    is_pickup: bool
+    person_count: int
+    deadline: float
+
+# Stops of a taxi with a reservation inserted, cost is the number of seconds
+# it adds to the time the taxi takes to get through all of its stops
+@dataclass
+class Insertion:
+    stops: List[Stop]
+    arrival_times: List[float]
+    cost: float
+
+    # Reservation ids in the order of the stops, as taken by dispatchTaxi
+    @property
+    def reservation_ids(self) -> List[str]:
+        return [stop.reservation_id for stop in self.stops]
+
+
+# Reservation ids a taxi still has to stop for, in the format of dispatchTaxi, given
+# those it was last dispatched with. Reservations which are over are left out, and
+# those which were already picked up are only listed once, for their drop-off
+def remaining_reservation_ids(dispatched_ids: Sequence[str], active_ids, picked_up_ids) -> List[str]:
+    counts = Counter(dispatched_ids)
+    seen = set()
+    remaining = []
+    for reservation_id in dispatched_ids:
+        first = reservation_id not in seen
+        seen.add(reservation_id)
+        if (reservation_id not in active_ids):
+            continue
+        if (first and counts[reservation_id] == 2 and reservation_id in picked_up_ids):
+            continue
+        remaining.append(reservation_id)
+    return remaining
+
+# Stops for the remaining reservation ids of a taxi, along with the number of people
+# already in it. Deadlines are looked up by reservation id and whether the stop is a
+# pickup, stops without one must not be reached any later than they are now
+def taxi_stops(reservation_ids: Sequence[str], reservations: Dict, deadlines: Dict[Tuple[str, bool], float]) -> Tuple[List[Stop], int]:
+    counts = Counter(reservation_ids)
+    seen = set()
+    stops = []
+    onboard_count = 0
+    for reservation_id in reservation_ids:
+        reservation = reservations[reservation_id]
+        is_pickup = reservation_id not in seen and counts[reservation_id] == 2
+        seen.add(reservation_id)
+        person_count = len(reservation.persons)
+        if (counts[reservation_id] == 1):
+            onboard_count += person_count
+        stops.append(Stop(
+            reservation_id,
+            reservation.fromEdge if is_pickup else reservation.toEdge,
+            is_pickup,
+            person_count,
+            deadlines.get((reservation_id, is_pickup), -math.inf)
+        ))
+    return stops, onboard_count
+
+
+# Times at which a taxi starting from an edge gets to each of its stops. travel_time gives
+# the seconds from one edge to another, or None if there is no route between them, in
+# which case None is returned
+def arrival_times(start_edge_id: str, start_time: float, stops: Sequence[Stop],
+                  travel_time: Callable[[str, str], Optional[float]]) -> Optional[List[float]]:
+    times = []
+    edge_id = start_edge_id
+    now = start_time
+    for stop in stops:
+        seconds = travel_time(edge_id, stop.edge_id)
+        if (seconds == None):
+            return None
+        now += seconds
+        times.append(now)
+        now += pickup_duration if stop.is_pickup else dropoff_duration
+        edge_id = stop.edge_id
+    return times
+
+def finish_time(start_time: float, stops: Sequence[Stop], times: Sequence[float]) -> float:
+    if (len(stops) == 0):
+        return start_time
+    return times[-1] + (pickup_duration if stops[-1].is_pickup else dropoff_duration)
+
+# Find the cheapest way of adding the pickup and drop-off of a reservation to the stops of
+# a taxi, keeping the existing stops in order. No more than capacity people can be in the
+# taxi at once, the new pickup has to be reached by its deadline and the people picked up
+# can spend at most max_ride_time seconds in the taxi. Existing stops can't be reached
+# after both their deadline and the time they would have been reached otherwise. Returns
+# None if the reservation can't be fitted in
+def insert_reservation(start_edge_id: str, start_time: float, stops: List[Stop], onboard_count: int, capacity: int,
+                       pickup: Stop, dropoff: Stop, max_ride_time: float,
+                       travel_time: Callable[[str, str], Optional[float]]) -> Optional[Insertion]:
+
+    current_times = arrival_times(start_edge_id, start_time, stops, travel_time)
+    if (current_times == None):
+        return None
+    current_finish_time = finish_time(start_time, stops, current_times)
+
+    # Number of people in the taxi as it leaves each stop
+    loads = []
+    load = onboard_count
+    for stop in stops:
+        load += stop.person_count if stop.is_pickup else -stop.person_count
+        loads.append(load)
+
+    best = None
+    for i in range(len(stops)+1):
+        if ((onboard_count if i == 0 else loads[i-1]) + pickup.person_count > capacity):
+            continue
+        for j in range(i, len(stops)+1):
+            # The people picked up are in the taxi for stops i to j-1
+            if (j > i and loads[j-1] + pickup.person_count > capacity):
+                break
+            candidate = stops[:i] + [pickup] + stops[i:j] + [dropoff] + stops[j:]
+            times = arrival_times(start_edge_id, start_time, candidate, travel_time)
+            if (times == None):
+                continue
+            if (times[i] > pickup.deadline or times[j+1] - times[i] > max_ride_time):
+                continue
+            if (any(times[k + (k >= i) + (k >= j)] > max(stop.deadline, current_times[k]) for k, stop in enumerate(stops))):
+                continue
+            cost = finish_time(start_time, candidate, times) - current_finish_time
+            if (best == None or cost < best.cost):
+                candidate[j+1] = replace(dropoff, deadline=times[i] + max_ride_time)
+                best = Insertion(candidate, times, cost)
+    return best
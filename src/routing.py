@@ -0,0 +1,415 @@
+from typing import Dict, List, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+import heapq
+import math
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from network import Network, StringTable
+
+
+# Build the graph of which edges lead directly to which other edges for a
+# vehicle class, returns the CSR offsets and targets of the graph, where the
+# successors of edge i are targets[offsets[i]:offsets[i+1]], along with the
+# mask of edges the vehicle class may use
+def edge_graph(network: Network, vclass: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    allowed_lanes = network.vclass_lanes(vclass)
+    lane_edges = network.lane_edges()
+    edge_count = len(network.edge_ids)
+    allowed_edges = np.bincount(lane_edges[allowed_lanes], minlength=edge_count) > 0
+
+    from_lanes = np.asarray(network.connection_from_lanes)
+    to_lanes = np.asarray(network.connection_to_lanes)
+    usable = allowed_lanes[from_lanes] & allowed_lanes[to_lanes]
+    links = np.unique(np.stack((lane_edges[from_lanes[usable]], lane_edges[to_lanes[usable]]), axis=1), axis=0)
+
+    offsets = np.zeros(edge_count+1, dtype=np.int64)
+    np.cumsum(np.bincount(links[:, 0], minlength=edge_count), out=offsets[1:])
+    return offsets, links[:, 1].astype(np.int64), allowed_edges
+
+# Find the strongly connected components of a graph given in CSR form using
+# an iterative version of Tarjan's algorithm, returns the component of each node
+def strongly_connected_components(offsets: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    offsets: List[int] = offsets.tolist()
+    targets: List[int] = targets.tolist()
+    node_count = len(offsets)-1
+
+    indices = [-1] * node_count
+    low_links = [0] * node_count
+    on_stack = [False] * node_count
+    components = [-1] * node_count
+    stack = []
+    counter = 0
+    component_count = 0
+
+    for root in range(node_count):
+        if (indices[root] != -1):
+            continue
+
+        indices[root] = low_links[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, offsets[root])]
+
+        while work:
+            node, next_target = work[-1]
+            if (next_target < offsets[node+1]):
+                work[-1] = (node, next_target+1)
+                target = targets[next_target]
+                if (indices[target] == -1):
+                    indices[target] = low_links[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append((target, offsets[target]))
+                elif (on_stack[target]):
+                    low_links[node] = min(low_links[node], indices[target])
+                continue
+
+            work.pop()
+            if (work):
+                parent = work[-1][0]
+                low_links[parent] = min(low_links[parent], low_links[node])
+
+            # Node is the root of a component, which is everything above it on the stack
+            if (low_links[node] == indices[node]):
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    components[member] = component_count
+                    if (member == node):
+                        break
+                component_count += 1
+
+    return np.array(components, dtype=np.int64)
+
+
+# Strongly connected components of the edges a vehicle class can drive on,
+# any edge of a component can be reached from any other edge of it
+class Reachability:
+
+    def __init__(self, network: Network, vclass: str = 'taxi'):
+        offsets, targets, allowed_edges = edge_graph(network, vclass)
+        self.edge_components = strongly_connected_components(offsets, targets)
+        self.edge_components[~allowed_edges] = -1
+
+        component_sizes = np.bincount(self.edge_components[allowed_edges])
+        self.giant_component = int(np.argmax(component_sizes)) if len(component_sizes) > 0 else -1
+
+    # Get mask of the edges in the largest component
+    def giant_component_edges(self) -> np.ndarray:
+        return self.edge_components == self.giant_component
+
+    # Check whether it is possible to drive from one edge to the other and back again
+    def is_reachable(self, from_edge_index: int, to_edge_index: int) -> bool:
+        component = self.edge_components[from_edge_index]
+        return component != -1 and component == self.edge_components[to_edge_index]
+
+
+# Length of each edge, which is that of its first lane
+def edge_lengths(network: Network) -> np.ndarray:
+    segments, segment_lanes = network.lane_segments()
+    segment_lengths = np.hypot(segments[:, 2]-segments[:, 0], segments[:, 3]-segments[:, 1])
+    lane_lengths = np.bincount(segment_lanes, weights=segment_lengths, minlength=len(network.lane_ids))
+    return lane_lengths[np.asarray(network.edge_lane_offsets[:-1])]
+
+# Time taken to drive along each edge at the speed limit, using the length
+# and speed of its first lane
+def edge_travel_times(network: Network) -> np.ndarray:
+    first_lanes = np.asarray(network.edge_lane_offsets[:-1])
+    # Edges of length 0 would look like missing links to scipy
+    return np.maximum(edge_lengths(network) / np.asarray(network.lane_speeds)[first_lanes], 1e-3)
+
+
+# Route between two edges as given by traci.simulation.findRoute, with the edge ids,
+# length and travel time of the route. A route of length 0 means there is none
+@dataclass
+class FoundRoute:
+    edges: List[str]
+    length: float
+    travelTime: float
+
+
+# Finds fastest routes between edges without SUMO, on the graph of which edges lead
+# to which for a vehicle class. The cost of a route is the time taken to drive all
+# of its edges, including the first and last, so it is comparable to the travel time
+# of SUMO's findRoute for an empty network
+class Router:
+
+    def __init__(self, network: Network, vclass: str = 'taxi'):
+        self.network = network
+        self.offsets, self.targets, self.allowed_edges = edge_graph(network, vclass)
+        self.travel_times = edge_travel_times(network)
+        self.edge_lengths = edge_lengths(network)
+        edge_count = len(self.offsets)-1
+
+        # Graph with edges reversed, for searching backwards from destinations
+        sources = np.repeat(np.arange(edge_count), np.diff(self.offsets))
+        order = np.argsort(self.targets, kind='stable')
+        self.reverse_offsets = np.zeros(edge_count+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.targets, minlength=edge_count), out=self.reverse_offsets[1:])
+        self.reverse_targets = sources[order]
+
+        # Searches are quicker on plain lists than on arrays
+        self.offset_list: List[int] = self.offsets.tolist()
+        self.target_list: List[int] = self.targets.tolist()
+        self.reverse_offset_list: List[int] = self.reverse_offsets.tolist()
+        self.reverse_target_list: List[int] = self.reverse_targets.tolist()
+        self.travel_time_list: List[float] = self.travel_times.tolist()
+        self.edge_length_list: List[float] = self.edge_lengths.tolist()
+
+        self.matrix = None
+
+    # Find fastest route with a bidirectional Dijkstra search, returns its travel
+    # time and edge indices, or infinity and an empty list if there is no route
+    def route(self, from_edge_index: int, to_edge_index: int) -> Tuple[float, List[int]]:
+        if (not self.allowed_edges[from_edge_index] or not self.allowed_edges[to_edge_index]):
+            return math.inf, []
+        if (from_edge_index == to_edge_index):
+            return self.travel_time_list[from_edge_index], [from_edge_index]
+
+        travel_times = self.travel_time_list
+        # Driving onto an edge costs its travel time, the first edge is added at the end
+        searches = [
+            (self.offset_list, self.target_list, {from_edge_index: 0.0}, {from_edge_index: -1}, [(0.0, from_edge_index)]),
+            (self.reverse_offset_list, self.reverse_target_list, {to_edge_index: 0.0}, {to_edge_index: -1}, [(0.0, to_edge_index)])
+        ]
+        settled = [set(), set()]
+        best = math.inf
+        meeting = -1
+
+        while searches[0][4] and searches[1][4]:
+            if (searches[0][4][0][0] + searches[1][4][0][0] >= best):
+                break
+            side = 0 if searches[0][4][0][0] <= searches[1][4][0][0] else 1
+            offsets, targets, dists, parents, heap = searches[side]
+            other_dists = searches[1-side][2]
+
+            dist, node = heapq.heappop(heap)
+            if (node in settled[side]):
+                continue
+            settled[side].add(node)
+
+            for target in targets[offsets[node]:offsets[node+1]]:
+                # Forwards, driving onto target costs its time, backwards, driving off it costs that of node
+                new_dist = dist + (travel_times[target] if side == 0 else travel_times[node])
+                if (new_dist < dists.get(target, math.inf)):
+                    dists[target] = new_dist
+                    parents[target] = node
+                    heapq.heappush(heap, (new_dist, target))
+                if (target in other_dists):
+                    total = dists[target] + other_dists[target]
+                    if (total < best):
+                        best = total
+                        meeting = target
+
+        if (meeting == -1):
+            return math.inf, []
+
+        path = []
+        node = meeting
+        while node != -1:
+            path.append(node)
+            node = searches[0][3][node]
+        path.reverse()
+        node = searches[1][3][meeting]
+        while node != -1:
+            path.append(node)
+            node = searches[1][3][node]
+        return best + travel_times[from_edge_index], path
+
+    def travel_time(self, from_edge_index: int, to_edge_index: int) -> float:
+        return self.route(from_edge_index, to_edge_index)[0]
+
+    # Find fastest route between edges given by id, in the same way as traci's findRoute
+    # so that it can be used in its place. Routes are always for the vehicle class of
+    # the router, whatever the vehicle type
+    def find_route(self, from_edge: str, to_edge: str, vType: str = '') -> FoundRoute:
+        time, path = self.route(self.network.edge_index(from_edge), self.network.edge_index(to_edge))
+        if (len(path) == 0):
+            return FoundRoute([], 0.0, 0.0)
+        edge_ids = self.network.edge_ids
+        return FoundRoute([edge_ids[edge_index] for edge_index in path],
+                          sum(self.edge_length_list[edge_index] for edge_index in path), time)
+
+    # Find the travel times from each source edge to every target edge, sources are
+    # searched a chunk at a time to bound the memory used
+    def travel_times_from(self, source_edges: np.ndarray, target_edges: np.ndarray, chunk_size: int = 64,
+                          dtype=np.float64) -> np.ndarray:
+        if (self.matrix is None):
+            # Arcs cost the travel time of the edge they lead onto
+            self.matrix = csr_matrix((self.travel_times[self.targets], self.targets, self.offsets),
+                                     shape=(len(self.travel_times), len(self.travel_times)))
+        source_edges = np.asarray(source_edges, dtype=np.int64)
+        target_edges = np.asarray(target_edges, dtype=np.int64)
+
+        times = np.full((len(source_edges), len(target_edges)), np.inf, dtype=dtype)
+        for start in range(0, len(source_edges), chunk_size):
+            sources = source_edges[start:start+chunk_size]
+            dists = dijkstra(self.matrix, directed=True, indices=sources)
+            times[start:start+len(sources)] = dists[:, target_edges] + self.travel_times[sources, None]
+
+        # Edges the vehicle class may not use can't be the start or end of a route
+        times[~self.allowed_edges[source_edges], :] = np.inf
+        times[:, ~self.allowed_edges[target_edges]] = np.inf
+        return times
+
+
+# Group points into at most max_zones zones of a square grid, the cells are made
+# larger until few enough of them hold points. Returns the zone of each point
+def grid_zones(points: np.ndarray, max_zones: int, cell_size: float = 250) -> np.ndarray:
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if (len(points) == 0):
+        return np.empty(0, dtype=np.int64)
+    while True:
+        cells = np.floor((points - points.min(axis=0)) / cell_size).astype(np.int64)
+        _, zones = np.unique(cells, axis=0, return_inverse=True)
+        zones = zones.reshape(-1)
+        if (zones.max()+1 <= max_zones):
+            return zones
+        cell_size *= 2
+
+
+# Travel times between TAZs, measured between a central edge of each zone. TAZs
+# are grouped into zones of nearby TAZs when there are too many of them for a
+# matrix of travel times between each pair to fit in memory, otherwise each
+# TAZ is its own zone. Times are stored as float32 to halve the size
+class TazTravelTimes:
+
+    def __init__(self, taz_ids: List[str], zones: np.ndarray, centre_edges: np.ndarray, travel_times: np.ndarray):
+        self.taz_ids = taz_ids
+        self.zones = zones
+        self.centre_edges = centre_edges
+        self.travel_times = travel_times
+        self.taz_indices: Dict[str, int] = {taz_id: i for i, taz_id in enumerate(taz_ids)}
+
+    def travel_time(self, from_taz_id: str, to_taz_id: str) -> float:
+        from_zone = self.zones[self.taz_indices[from_taz_id]]
+        to_zone = self.zones[self.taz_indices[to_taz_id]]
+        if (from_zone == -1 or to_zone == -1):
+            return math.inf
+        return float(self.travel_times[from_zone, to_zone])
+
+    # Compute the travel times of TAZs with the given edges, the central edge of a
+    # TAZ is the one of its edges the vehicle class may use which is closest to the
+    # middle of them, TAZs without any such edge are unreachable. When there are more
+    # than max_zones TAZs they are grouped into zones, the central edge of a zone
+    # being the central edge of its TAZs which is closest to the middle of them
+    @staticmethod
+    def compute(taz_ids: List[str], taz_edge_offsets: np.ndarray, taz_edges: np.ndarray, router: Router,
+                max_zones: int = None) -> 'TazTravelTimes':
+        network = router.network
+        first_lanes = np.asarray(network.edge_lane_offsets)[taz_edges]
+        lane_shape_offsets = np.asarray(network.lane_shape_offsets)
+        coords = np.asarray(network.coords)
+        edge_points = (coords[lane_shape_offsets[first_lanes]] + coords[lane_shape_offsets[first_lanes+1]-1]) / 2
+        usable = router.allowed_edges[taz_edges]
+
+        taz_centre_edges = np.full(len(taz_ids), -1, dtype=np.int64)
+        taz_centre_points = np.zeros((len(taz_ids), 2))
+        for i in range(len(taz_ids)):
+            start, end = taz_edge_offsets[i], taz_edge_offsets[i+1]
+            candidates = np.arange(start, end)[usable[start:end]]
+            if (len(candidates) == 0):
+                continue
+            centre = edge_points[candidates].mean(axis=0)
+            closest = candidates[np.argmin(np.hypot(*(edge_points[candidates] - centre).T))]
+            taz_centre_edges[i] = taz_edges[closest]
+            taz_centre_points[i] = edge_points[closest]
+
+        has_centre = np.flatnonzero(taz_centre_edges != -1)
+        zones = np.full(len(taz_ids), -1, dtype=np.int64)
+        if (max_zones == None or len(has_centre) <= max_zones):
+            zones[has_centre] = np.arange(len(has_centre))
+            centre_edges = taz_centre_edges[has_centre]
+        else:
+            zones[has_centre] = grid_zones(taz_centre_points[has_centre], max_zones)
+            centre_edges = np.empty(zones.max()+1, dtype=np.int64)
+            for zone in range(len(centre_edges)):
+                members = has_centre[zones[has_centre] == zone]
+                centre = taz_centre_points[members].mean(axis=0)
+                centre_edges[zone] = taz_centre_edges[members[np.argmin(np.hypot(*(taz_centre_points[members] - centre).T))]]
+
+        travel_times = router.travel_times_from(centre_edges, centre_edges, dtype=np.float32)
+        return TazTravelTimes(taz_ids, zones, centre_edges, travel_times)
+
+def store_taz_travel_times(taz_travel_times: TazTravelTimes, path: str):
+    taz_ids = StringTable.from_strings(list(taz_travel_times.taz_ids))
+    with open(path, 'wb') as outp:
+        np.savez_compressed(outp,
+                            taz_ids_offsets=taz_ids.offsets,
+                            taz_ids_blob=taz_ids.blob,
+                            zones=taz_travel_times.zones,
+                            centre_edges=taz_travel_times.centre_edges,
+                            travel_times=taz_travel_times.travel_times)
+
+def retrieve_taz_travel_times(path: str) -> TazTravelTimes:
+    with np.load(path) as archive:
+        return TazTravelTimes(
+            list(StringTable(archive['taz_ids_offsets'], archive['taz_ids_blob'])),
+            archive['zones'],
+            archive['centre_edges'],
+            archive['travel_times']
+        )
+
+
+# Cache of route queries keyed by origin edge, destination edge and vehicle type,
+# for a function with the signature of traci.simulation.findRoute. When there are
+# more than max_size routes the least recently used are dropped, and routes older
+# than ttl seconds of simulation time are looked up again, so that travel times
+# follow congestion. Unreachable pairs, for which the route has length 0, are kept
+# in the same way but with their own ttl
+class RouteCache:
+
+    def __init__(self, find_route, max_size: int = 100000, ttl: float = None, unreachable_ttl: float = None):
+        self.find_route_uncached = find_route
+        self.max_size = max_size
+        self.ttl = ttl
+        self.unreachable_ttl = unreachable_ttl
+        self.time = 0.0
+        self.routes: 'OrderedDict[Tuple[str, str, str], Tuple[float, object]]' = OrderedDict()
+
+        self.hits = 0
+        self.unreachable_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    # Set the current simulation time, against which ages of routes are measured
+    def set_time(self, time: float):
+        self.time = time
+
+    def find_route(self, from_edge: str, to_edge: str, vtype: str = ''):
+        key = (from_edge, to_edge, vtype)
+        cached = self.routes.get(key)
+        if (cached != None):
+            found_time, route = cached
+            ttl = self.ttl if route.length != 0 else self.unreachable_ttl
+            if (ttl == None or self.time - found_time < ttl):
+                self.routes.move_to_end(key)
+                if (route.length != 0):
+                    self.hits += 1
+                else:
+                    self.unreachable_hits += 1
+                return route
+            self.expired += 1
+
+        self.misses += 1
+        route = self.find_route_uncached(from_edge, to_edge, vType=vtype)
+        self.routes[key] = (self.time, route)
+        self.routes.move_to_end(key)
+        if (len(self.routes) > self.max_size):
+            self.routes.popitem(last=False)
+        return route
+
+    def is_reachable(self, from_edge: str, to_edge: str, vtype: str = '') -> bool:
+        return self.find_route(from_edge, to_edge, vtype).length != 0
+
+    def stats(self) -> str:
+        lookups = self.hits + self.unreachable_hits + self.misses
+        return '{} route lookups, {} hits, {} unreachable hits, {} misses ({} expired), {:.1f}% hit rate, {} cached'.format(
+            lookups, self.hits, self.unreachable_hits, self.misses, self.expired,
+            100*(self.hits + self.unreachable_hits)/lookups if lookups > 0 else 0, len(self.routes))
@@ -0,0 +1,168 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from datatypes import Edge, Taz, Driver, Trip
+from network import Network
+
+
+# Alias table for drawing from a discrete distribution in constant time,
+# built using Vose's method
+class AliasTable:
+
+    def __init__(self, weights: Iterable[float]):
+        weights = np.asarray(list(weights), dtype=np.float64)
+        n = len(weights)
+        self.probabilities = np.ones(n)
+        self.aliases = np.arange(n)
+
+        scaled = weights * n / weights.sum()
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1
+            if (scaled[more] < 1):
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left over only differs from 1 because of rounding
+        for i in small + large:
+            self.probabilities[i] = 1
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    def sample(self, generator: np.random.Generator, size: int) -> np.ndarray:
+        bins = generator.integers(len(self.probabilities), size=size)
+        keep = generator.random(size) < self.probabilities[bins]
+        return np.where(keep, bins, self.aliases[bins])
+
+
+# Drivable edges of each TAZ as indices of edges in the network, the edges of
+# TAZ i are edges[edge_offsets[i]:edge_offsets[i+1]]
+class TazEdges:
+
+    def __init__(self, taz_ids: List[str], weights: np.ndarray, edge_offsets: np.ndarray, edges: np.ndarray):
+        self.taz_ids = taz_ids
+        self.weights = weights
+        self.edge_offsets = edge_offsets
+        self.edges = edges
+
+    def __len__(self):
+        return len(self.taz_ids)
+
+    @staticmethod
+    def from_tazs(tazs: List[Taz], network: Network) -> 'TazEdges':
+        edge_offsets = np.zeros(len(tazs)+1, dtype=np.int64)
+        np.cumsum([len(taz.drivable_edges) for taz in tazs], out=edge_offsets[1:])
+        return TazEdges(
+            [taz.id for taz in tazs],
+            np.array([taz.weight for taz in tazs], dtype=np.float64),
+            edge_offsets,
+            np.array([network.edge_index(edge_id) for taz in tazs for edge_id in taz.drivable_edges], dtype=np.int64)
+        )
+
+    # Only keep the edges in the given mask, dropping TAZs left without any edges
+    def filter(self, edge_mask: np.ndarray) -> 'TazEdges':
+        keep = edge_mask[self.edges]
+        edge_tazs = np.repeat(np.arange(len(self.taz_ids)), np.diff(self.edge_offsets))
+        edge_counts = np.bincount(edge_tazs[keep], minlength=len(self.taz_ids))
+        kept_tazs = np.flatnonzero(edge_counts)
+
+        edge_offsets = np.zeros(len(kept_tazs)+1, dtype=np.int64)
+        np.cumsum(edge_counts[kept_tazs], out=edge_offsets[1:])
+        return TazEdges(
+            [self.taz_ids[taz_index] for taz_index in kept_tazs],
+            self.weights[kept_tazs],
+            edge_offsets,
+            self.edges[keep]
+        )
+
+
+# Draws random drivable edges, half of them from a TAZ picked according to the
+# TAZ weights and the other half uniformly from all drivable edges. If a mask of
+# allowed edges is given, only those edges are drawn and TAZs without any are dropped
+class EdgeSampler:
+
+    def __init__(self, taz_edges: TazEdges, network: Network, seed: int = None, allowed_edges: np.ndarray = None):
+        self.generator = np.random.default_rng(seed)
+        if (allowed_edges is None):
+            allowed_edges = np.ones(len(network.edge_ids), dtype=bool)
+
+        # Edges by index in the network and by id
+        self.edge_list: List[Edge] = network.edges()
+        self.edges: Dict[str, Edge] = {edge.id: edge for edge in self.edge_list}
+
+        self.drivable_edges = np.flatnonzero(np.asarray(network.edge_drivable) & allowed_edges)
+
+        # Drivable edges of TAZ i are taz_edges[taz_edge_offsets[i]:taz_edge_offsets[i+1]]
+        taz_edges = taz_edges.filter(allowed_edges)
+        self.taz_table = AliasTable(taz_edges.weights)
+        self.taz_edge_offsets = taz_edges.edge_offsets
+        self.taz_edges = taz_edges.edges
+
+    # Restart draws from the given seed
+    def reseed(self, seed):
+        self.generator = np.random.default_rng(seed)
+
+    # Draw the indices of n random drivable edges
+    def sample_indices(self, n: int) -> np.ndarray:
+        edge_indices = np.empty(n, dtype=np.int64)
+
+        from_taz = self.generator.random(n) <= 0.5
+        taz_indices = self.taz_table.sample(self.generator, int(from_taz.sum()))
+        starts = self.taz_edge_offsets[taz_indices]
+        counts = self.taz_edge_offsets[taz_indices+1] - starts
+        edge_indices[from_taz] = self.taz_edges[starts + self.generator.integers(counts)]
+
+        edge_indices[~from_taz] = self.drivable_edges[
+            self.generator.integers(len(self.drivable_edges), size=n-len(taz_indices))]
+
+        return edge_indices
+
+    # Draw n pairs of origin and destination edge indices, where
+    # the origin is never the same as the destination
+    def sample_pair_indices(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        origins = self.sample_indices(n)
+        destinations = self.sample_indices(n)
+        same = np.flatnonzero(origins == destinations)
+        while (len(same) > 0):
+            origins[same] = self.sample_indices(len(same))
+            destinations[same] = self.sample_indices(len(same))
+            same = same[origins[same] == destinations[same]]
+        return origins, destinations
+
+    def sample(self) -> Edge:
+        return self.edge_list[self.sample_indices(1)[0]]
+
+    def sample_pairs(self, n: int) -> List[Tuple[Edge, Edge]]:
+        origins, destinations = self.sample_pair_indices(n)
+        return [(self.edge_list[origin], self.edge_list[destination]) for origin, destination in zip(origins, destinations)]
+
+
+# Give drivers their outbound and return trips hour by hour. Each hour's trips go to
+# distinct drivers drawn without replacement from those who don't have both trips yet,
+# so a driver's return trip is always in a later hour than their outbound trip
+def schedule_trips(drivers: List[Driver], hourly_trip_counts: Dict[int, int], generator: np.random.Generator):
+    trip_counts = np.zeros(len(drivers), dtype=np.int8)
+    trip_id = 0
+
+    for hour in sorted(hourly_trip_counts):
+        eligible_drivers = np.flatnonzero(trip_counts < 2)
+        chosen_drivers = generator.choice(
+            eligible_drivers, size=min(hourly_trip_counts[hour], len(eligible_drivers)), replace=False)
+        departs = hour*3600 + np.round(generator.random(len(chosen_drivers))*3600)
+
+        for driver_index, depart in zip(chosen_drivers.tolist(), departs.tolist()):
+            driver = drivers[driver_index]
+            if (driver.trip1 == None):
+                driver.trip1 = Trip(trip_id, depart, driver.home_edge.id, driver.destination_edge.id)
+            else:
+                driver.trip2 = Trip(trip_id, depart, driver.destination_edge.id, driver.home_edge.id)
+            trip_id += 1
+
+        trip_counts[chosen_drivers] += 1
@@ -0,0 +1,349 @@
+from typing import Dict, List, Optional, Tuple
+import json
+import math
+import os
+
+import numpy as np
+from shapely.geometry import shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from datatypes import Lane, Edge, CountPoint
+from utilities import retrieve, store
+
+
+# Get distance from count_point to to lane
+def min_dist_to_lane(lane: Lane, count_point: CountPoint) -> float:
+
+    min_dist = -1;
+
+    for i in range(1, len(lane.shape)):
+        x = count_point.utm[0];
+        y = count_point.utm[1];
+        x1 = lane.shape[i-1][0];
+        y1 = lane.shape[i-1][1];
+        x2 = lane.shape[i][0];
+        y2 = lane.shape[i][1];
+
+        A = x - x1;
+        B = y - y1;
+        C = x2 - x1;
+        D = y2 - y1;
+
+        dot = A * C + B * D;
+        len_sq = C * C + D * D;
+        param = -1;
+        if (len_sq != 0):
+            param = dot / len_sq;
+
+        xx = 0.0;
+        yy = 0.0;
+
+        if (param < 0):
+            xx = x1;
+            yy = y1;
+        elif (param > 1):
+            xx = x2;
+            yy = y2;
+        else:
+            xx = x1 + param * C;
+            yy = y1 + param * D;
+
+        dx = x - xx;
+        dy = y - yy;
+        dist = math.sqrt(dx * dx + dy * dy);
+
+        if (min_dist == -1 or dist<min_dist):
+            min_dist = dist;
+
+    return min_dist;
+
+
+# Find closest lane to count_point by checking every lane of the network
+def closest_lane_brute_force(edges: List[Edge], count_point: CountPoint) -> Tuple[float, Lane]:
+    closest_lane: Tuple[float, Lane] = (-1, None)
+
+    for edge in edges:
+        for lane in edge.lanes:
+            dist = min_dist_to_lane(lane, count_point)
+            if (closest_lane[0] == -1 or dist<closest_lane[0]):
+                closest_lane = (dist, lane)
+
+    return closest_lane
+
+
+# Pack the segments of the given lanes into rows of (x1, y1, x2, y2), along
+# with the index of the lane which each segment belongs to
+def pack_lane_segments(lanes: List[Lane]) -> Tuple[np.ndarray, np.ndarray]:
+    segments = []
+    segment_lanes = []
+    for lane_index, lane in enumerate(lanes):
+        for i in range(1, len(lane.shape)):
+            segments.append((lane.shape[i-1][0], lane.shape[i-1][1], lane.shape[i][0], lane.shape[i][1]))
+            segment_lanes.append(lane_index)
+
+    return np.array(segments, dtype=np.float64).reshape(-1, 4), np.array(segment_lanes, dtype=np.int64)
+
+# Get distance from every point to every segment, this does the same
+# operations as min_dist_to_lane so that results agree with it
+def point_segment_distances(points: np.ndarray, segments: np.ndarray) -> np.ndarray:
+    x = points[:, 0, np.newaxis]
+    y = points[:, 1, np.newaxis]
+    x1 = segments[np.newaxis, :, 0]
+    y1 = segments[np.newaxis, :, 1]
+    x2 = segments[np.newaxis, :, 2]
+    y2 = segments[np.newaxis, :, 3]
+
+    A = x - x1
+    B = y - y1
+    C = x2 - x1
+    D = y2 - y1
+
+    dot = A * C + B * D
+    len_sq = C * C + D * D
+    with np.errstate(divide='ignore', invalid='ignore'):
+        param = np.where(len_sq != 0, dot / len_sq, -1)
+
+    xx = np.where(param < 0, x1, np.where(param > 1, x2, x1 + param * C))
+    yy = np.where(param < 0, y1, np.where(param > 1, y2, y1 + param * D))
+
+    dx = x - xx
+    dy = y - yy
+    return np.sqrt(dx * dx + dy * dy)
+
+# Find the closest lane to each point, returns the index of the lane and the
+# distance to it, or -1 and inf for points which have no segment closer than max_dist
+def closest_lanes(points: np.ndarray, segments: np.ndarray, segment_lanes: np.ndarray,
+                  max_dist: float = math.inf, chunk_size: int = 1 << 22) -> Tuple[np.ndarray, np.ndarray]:
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lane_indices = np.full(len(points), -1, dtype=np.int64)
+    dists = np.full(len(points), math.inf)
+    if (len(segments) == 0):
+        return lane_indices, dists
+
+    # Split points into chunks to bound the size of the distance matrix
+    points_per_chunk = max(1, chunk_size // len(segments))
+    for start in range(0, len(points), points_per_chunk):
+        chunk_dists = point_segment_distances(points[start:start+points_per_chunk], segments)
+        # argmin returns the first minimum, so ties go to the first lane
+        # in network order like in closest_lane_brute_force
+        closest_segments = np.argmin(chunk_dists, axis=1)
+        min_dists = chunk_dists[np.arange(len(closest_segments)), closest_segments]
+        found = min_dists < max_dist
+        lane_indices[start:start+points_per_chunk][found] = segment_lanes[closest_segments[found]]
+        dists[start:start+points_per_chunk][found] = min_dists[found]
+
+    return lane_indices, dists
+
+
+# Uniform grid over the segments of every lane, so that a point only
+# needs to be checked against the segments which are near it
+class LaneGrid:
+
+    # Segments can be given if they are already packed, as for a Network
+    def __init__(self, edges: List[Edge], cell_size: float = 50, segments: Tuple[np.ndarray, np.ndarray] = None):
+        self.cell_size = cell_size
+
+        # Lanes are numbered in network order, so that ties are broken
+        # the same way as when checking every lane
+        self.lanes: List[Lane] = [lane for edge in edges for lane in edge.lanes]
+        self.segments, self.segment_lanes = segments if segments != None else pack_lane_segments(self.lanes)
+
+        cells: Dict[Tuple[int, int], List[int]] = {}
+        for segment_index, (x1, y1, x2, y2) in enumerate(self.segments.tolist()):
+            for cell in self.cells_in_box(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)):
+                cells.setdefault(cell, []).append(segment_index)
+        self.cells: Dict[Tuple[int, int], np.ndarray] = {
+            cell: np.array(segment_indices, dtype=np.int64) for cell, segment_indices in cells.items()
+        }
+
+    # Get all cells overlapping the given bounding box
+    def cells_in_box(self, min_x, min_y, max_x, max_y):
+        for i in range(math.floor(min_x/self.cell_size), math.floor(max_x/self.cell_size)+1):
+            for j in range(math.floor(min_y/self.cell_size), math.floor(max_y/self.cell_size)+1):
+                yield (i, j)
+
+    # Get indices of segments which might be within radius of any point
+    # of the given box, in network order
+    def candidate_segments(self, min_x, min_y, max_x, max_y, radius: float) -> np.ndarray:
+        candidates = [
+            self.cells[cell] for cell in self.cells_in_box(min_x-radius, min_y-radius, max_x+radius, max_y+radius)
+            if cell in self.cells
+        ]
+        if (not candidates):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(candidates))
+
+    # Find closest lane to each point which is less than radius away, points are
+    # batched by grid cell and each batch only checks the segments near its cell
+    def closest_lanes(self, points: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        lane_indices = np.full(len(points), -1, dtype=np.int64)
+        dists = np.full(len(points), math.inf)
+
+        point_cells = np.floor(points / self.cell_size).astype(np.int64)
+        cells, batches, batch_sizes = np.unique(point_cells, axis=0, return_inverse=True, return_counts=True)
+        batch_order = np.argsort(batches.reshape(-1), kind='stable')
+        batch_ends = np.cumsum(batch_sizes)
+        for batch, (i, j) in enumerate(cells.tolist()):
+            batch_points = batch_order[batch_ends[batch]-batch_sizes[batch]:batch_ends[batch]]
+            candidates = self.candidate_segments(
+                i*self.cell_size, j*self.cell_size, (i+1)*self.cell_size, (j+1)*self.cell_size, radius)
+            batch_lanes, batch_dists = closest_lanes(
+                points[batch_points], self.segments[candidates], self.segment_lanes[candidates], radius)
+            lane_indices[batch_points] = batch_lanes
+            dists[batch_points] = batch_dists
+
+        return lane_indices, dists
+
+    # Find closest lane to count_point which is less than radius away,
+    # gives the same result as closest_lane_brute_force for those points
+    def closest_lane(self, count_point: CountPoint, radius: float) -> Tuple[float, Lane]:
+        lane_indices, dists = self.closest_lanes([count_point.utm[0], count_point.utm[1]], radius)
+        if (lane_indices[0] == -1):
+            return (-1, None)
+        return (float(dists[0]), self.lanes[lane_indices[0]])
+
+
+
+# Grid of points which move between queries, such as idle taxis. Points are
+# kept by key along with an item, and can be added and removed at any time
+class PointGrid:
+
+    def __init__(self, cell_size: float = 500):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Dict[str, Tuple[float, float, int]]] = {}
+        self.points: Dict[str, Tuple[Tuple[int, int], object]] = {}
+        # Order in which points were added, used to break ties between equal distances
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key: str):
+        return key in self.points
+
+    def cell(self, x: float, y: float) -> Tuple[int, int]:
+        return (math.floor(x/self.cell_size), math.floor(y/self.cell_size))
+
+    def insert(self, key: str, position: Tuple[float, float], item=None):
+        if (key in self.points):
+            self.remove(key)
+        cell = self.cell(position[0], position[1])
+        self.cells.setdefault(cell, {})[key] = (position[0], position[1], self.counter)
+        self.points[key] = (cell, item)
+        self.counter += 1
+
+    def remove(self, key: str):
+        cell, _ = self.points.pop(key)
+        del self.cells[cell][key]
+        if (not self.cells[cell]):
+            del self.cells[cell]
+
+    # Move a point to a new position, or insert it if it isn't in the grid. The
+    # point keeps its place in the order used to break ties between distances
+    def move(self, key: str, position: Tuple[float, float], item=None):
+        if (key not in self.points):
+            self.insert(key, position, item)
+            return
+        cell, _ = self.points[key]
+        order = self.cells[cell][key][2]
+        new_cell = self.cell(position[0], position[1])
+        if (new_cell != cell):
+            del self.cells[cell][key]
+            if (not self.cells[cell]):
+                del self.cells[cell]
+        self.cells.setdefault(new_cell, {})[key] = (position[0], position[1], order)
+        self.points[key] = (new_cell, item)
+
+    # Get the cells at Chebyshev distance ring from a cell
+    def ring(self, cell: Tuple[int, int], ring: int):
+        i, j = cell
+        if (ring == 0):
+            yield cell
+            return
+        for di in range(-ring, ring+1):
+            yield (i+di, j-ring)
+            yield (i+di, j+ring)
+        for dj in range(-ring+1, ring):
+            yield (i-ring, j+dj)
+            yield (i+ring, j+dj)
+
+    # Find the k points closest to position, returns their squared distances and
+    # items from closest to furthest, points at the same distance are given in the
+    # order they were added. Rings of cells are searched outwards from the cell of
+    # the position until no point outside of the searched cells can be closer
+    def nearest(self, position: Tuple[float, float], k: int) -> List[Tuple[float, object]]:
+        x, y = position
+        centre = self.cell(x, y)
+        # Distance from the position to the edge of its cell
+        margin = min(x - centre[0]*self.cell_size, (centre[0]+1)*self.cell_size - x,
+                     y - centre[1]*self.cell_size, (centre[1]+1)*self.cell_size - y)
+
+        found = []
+        checked_count = 0
+        ring = 0
+        while checked_count < len(self.points):
+            # Once the rings cover more cells than are occupied, check the rest directly
+            if ((2*ring+1)**2 > len(self.cells)):
+                cells = [cell for cell in self.cells if max(abs(cell[0]-centre[0]), abs(cell[1]-centre[1])) >= ring]
+            else:
+                cells = [cell for cell in self.ring(centre, ring) if cell in self.cells]
+            for cell in cells:
+                for key, (point_x, point_y, order) in self.cells[cell].items():
+                    found.append(((point_x-x)**2 + (point_y-y)**2, order, key))
+                checked_count += len(self.cells[cell])
+
+            found.sort()
+            reach = margin + ring*self.cell_size
+            if (len(found) >= k and found[k-1][0] <= reach*reach):
+                break
+            ring += 1
+
+        return [(dist, self.points[key][1]) for dist, _, key in found[:k]]
+
+
+# Finds which local authority points are in, the authorities are kept in an STR-tree so
+# only those whose bounding box contains a point are checked with their prepared geometry
+class LocalAuthorityLocator:
+
+    def __init__(self, geometries: list, properties: List[dict]):
+        self.geometries = geometries
+        self.properties = properties
+        self.tree = STRtree(geometries)
+        self.prepared = [prep(geometry) for geometry in geometries]
+
+    # Load local authorities from GeoJSON file, the parsed geometries are stored next
+    # to it so that later loads don't need to parse the GeoJSON again
+    @staticmethod
+    def load(geojson_path: str) -> 'LocalAuthorityLocator':
+        cache_path = os.path.splitext(geojson_path)[0] + '.pkl'
+        if (os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(geojson_path)):
+            geometries, properties = retrieve(cache_path)
+        else:
+            with open(geojson_path, 'r') as myfile:
+                local_authorities = json.load(myfile)
+            geometries = [shape(local_authority['geometry']) for local_authority in local_authorities['features']]
+            properties = [local_authority['properties'] for local_authority in local_authorities['features']]
+            store((geometries, properties), cache_path)
+
+        return LocalAuthorityLocator(geometries, properties)
+
+    # Get properties of the local authority containing each point, or None
+    # for points outside of every local authority
+    def locate_many(self, points: list) -> List[Optional[dict]]:
+        located: List[Optional[dict]] = [None for _ in points]
+        if (not points):
+            return located
+
+        # Pairs of point and local authority whose bounding boxes overlap, in reverse
+        # order so the last local authority in the file wins, as when they were all checked
+        point_indices, authority_indices = self.tree.query(points)
+        for point_index, authority_index in sorted(zip(point_indices.tolist(), authority_indices.tolist()), reverse=True):
+            if (located[point_index] == None and self.prepared[authority_index].contains(points[point_index])):
+                located[point_index] = self.properties[authority_index]
+
+        return located
+
+    def locate(self, point) -> Optional[dict]:
+        return self.locate_many([point])[0]
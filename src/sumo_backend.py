@@ -0,0 +1,44 @@
+import os
+import sys
+
+# We need to import python modules from the $SUMO_HOME/tools directory
+if 'SUMO_HOME' in os.environ:
+    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
+    sys.path.append(tools)
+    from sumolib import checkBinary
+    import traci.constants as tc
+else:
+    sys.exit("please declare environment variable 'SUMO_HOME'")
+
+
+# Ways of talking to SUMO, both have the same API. traci talks to a SUMO process
+# over a socket, so every call is a round trip, while libsumo runs SUMO inside
+# this process. The backend is picked with the SUMO_BACKEND environment variable
+backend_names = ['traci', 'libsumo']
+default_backend = 'traci'
+
+
+# Import the module of a backend, the name is also set in the environment so
+# that worker processes started from here use the same backend. Falls back to
+# traci if libsumo isn't available
+def load_backend(name: str = None):
+    if (name == None):
+        name = os.environ.get('SUMO_BACKEND', default_backend)
+    if (name not in backend_names):
+        raise ValueError('Unknown SUMO backend {}, choose from {}'.format(name, ', '.join(backend_names)))
+    os.environ['SUMO_BACKEND'] = name
+
+    if (name == 'libsumo'):
+        try:
+            import libsumo
+            return libsumo
+        except ImportError:
+            print('libsumo is not available, falling back to traci')
+
+    import traci
+    return traci
+
+# Add the option for picking a backend to an argument parser
+def add_backend_argument(parser):
+    parser.add_argument('--backend', choices=backend_names, default=None,
+                        help='how to talk to SUMO, defaults to $SUMO_BACKEND or {}'.format(default_backend))
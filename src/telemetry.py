@@ -0,0 +1,163 @@
+from typing import Dict, Iterator
+from collections import Counter
+from dataclasses import astuple, fields
+import argparse
+import csv
+import math
+import pickle
+import time
+
+from datatypes import TaxiSimulationLog, DispatchLog
+
+
+# Count, mean and maximum of the values seen since the last reset
+class RunningStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.maximum = value if self.count == 1 else max(self.maximum, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total/self.count if self.count > 0 else 0.0
+
+
+# Get a percentile of the values counted in a Counter
+def counter_percentile(counter: Counter, percentile: float) -> float:
+    total = sum(counter.values())
+    if (total == 0):
+        return 0.0
+    rank = math.ceil(total * percentile / 100)
+    seen = 0
+    for value in sorted(counter):
+        seen += counter[value]
+        if (seen >= max(rank, 1)):
+            return value
+    return max(counter)
+
+
+# Fields written to the telemetry file for each logging window, after those of TaxiSimulationLog
+window_fields = [
+    'idle_taxi_count_max',
+    'queue_length_mean', 'queue_length_p50', 'queue_length_p90', 'queue_length_max',
+    'window_dispatch_count', 'dispatch_latency_mean', 'dispatch_latency_max',
+    'solve_time_mean', 'solve_time_max'
+]
+telemetry_fields = [field.name for field in fields(TaxiSimulationLog)] + window_fields
+
+
+# Records the taxi simulation as it runs, keeping only running aggregates of the
+# current logging window in memory. At the end of each window a row is appended
+# to the telemetry CSV file and the TaxiSimulationLog is appended to the log
+# pickle, both are flushed straight away so they can be read while the run goes on
+# and are complete up to the last window if it is interrupted. Dispatch logs are
+# appended to their own pickle each step
+class TelemetrySink:
+
+    def __init__(self, telemetry_path: str, simulation_log_path: str, dispatch_log_path: str):
+        self.telemetry_file = open(telemetry_path, 'w', newline='')
+        self.telemetry_writer = csv.writer(self.telemetry_file)
+        self.telemetry_writer.writerow(telemetry_fields)
+        self.telemetry_file.flush()
+        self.simulation_log_file = open(simulation_log_path, 'wb')
+        self.dispatch_log_file = open(dispatch_log_path, 'wb')
+
+        self.idle_taxi_counts = RunningStats()
+        self.queue_lengths = RunningStats()
+        self.queue_length_counts = Counter()
+        self.dispatch_latencies = RunningStats()
+        self.solve_times = RunningStats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record_step(self, idle_taxi_count: int, queue_length: int):
+        self.idle_taxi_counts.add(idle_taxi_count)
+        self.queue_lengths.add(queue_length)
+        self.queue_length_counts[queue_length] += 1
+
+    # Record time in seconds between a reservation being made and a taxi being dispatched to it
+    def record_dispatch(self, latency: float):
+        self.dispatch_latencies.add(latency)
+
+    def record_dispatch_log(self, dispatch_log: DispatchLog):
+        self.solve_times.add(dispatch_log.solve_time)
+        pickle.dump(dispatch_log, self.dispatch_log_file, pickle.HIGHEST_PROTOCOL)
+
+    # Write out the current window and start a new one, returns the figures of the window
+    def end_window(self, simulation_log: TaxiSimulationLog) -> Dict[str, float]:
+        window = {
+            'idle_taxi_count_max': self.idle_taxi_counts.maximum,
+            'queue_length_mean': self.queue_lengths.mean,
+            'queue_length_p50': counter_percentile(self.queue_length_counts, 50),
+            'queue_length_p90': counter_percentile(self.queue_length_counts, 90),
+            'queue_length_max': self.queue_lengths.maximum,
+            'window_dispatch_count': self.dispatch_latencies.count,
+            'dispatch_latency_mean': self.dispatch_latencies.mean,
+            'dispatch_latency_max': self.dispatch_latencies.maximum,
+            'solve_time_mean': self.solve_times.mean,
+            'solve_time_max': self.solve_times.maximum
+        }
+        self.telemetry_writer.writerow(list(astuple(simulation_log)) + [window[field] for field in window_fields])
+        self.telemetry_file.flush()
+        pickle.dump(simulation_log, self.simulation_log_file, pickle.HIGHEST_PROTOCOL)
+        self.simulation_log_file.flush()
+        self.dispatch_log_file.flush()
+
+        for stats in (self.idle_taxi_counts, self.queue_lengths, self.dispatch_latencies, self.solve_times):
+            stats.reset()
+        self.queue_length_counts.clear()
+        return window
+
+    def close(self):
+        for openfile in (self.telemetry_file, self.simulation_log_file, self.dispatch_log_file):
+            if (not openfile.closed):
+                openfile.close()
+
+
+# Read rows of a telemetry file, when following, keep waiting for new rows
+# as they are written by a run which is still going, like tail -f
+def read_telemetry(path: str, follow: bool = False, poll_interval: float = 1.0) -> Iterator[Dict[str, float]]:
+    with open(path, 'r', newline='') as openfile:
+        def lines():
+            partial_line = ''
+            while True:
+                line = openfile.readline()
+                if (line == ''):
+                    if (not follow):
+                        return
+                    time.sleep(poll_interval)
+                    continue
+                partial_line += line
+                if (partial_line.endswith('\n')):
+                    yield partial_line
+                    partial_line = ''
+
+        for row in csv.DictReader(lines()):
+            yield {name: float(value) for name, value in row.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the rows of a taxi simulation telemetry file')
+    parser.add_argument('path', nargs='?', default=None,
+                        help='telemetry file, defaults to that of the run with the dispatch policy')
+    parser.add_argument('--dispatch-policy', default='greedy', help='dispatch policy of the run to follow')
+    parser.add_argument('--follow', action='store_true', help='keep printing rows as they are written')
+    args = parser.parse_args()
+    path = args.path if args.path != None else '../temp/taxi_{}_telemetry.csv'.format(args.dispatch_policy)
+    try:
+        for row in read_telemetry(path, args.follow):
+            print(', '.join('{}: {:g}'.format(name, value) for name, value in row.items()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,250 @@
+from typing import Dict, Iterator, List, Sequence, Tuple
+from dataclasses import dataclass
+import gzip
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from datatypes import TripInfo, TaxiSimulationLog
+from network import StringTable
+
+
+# Percentiles reported for each hour
+kpi_percentiles = (50, 90, 95)
+
+
+# Trip infos stored column by column, row i holds the same values as TripInfo i
+class TripInfoTable:
+
+    def __init__(self, trip_ids: Sequence[str], taxi_ids: Sequence[str], depart_time: np.ndarray,
+                 waiting_time: np.ndarray, duration: np.ndarray, length: np.ndarray, time_loss: np.ndarray):
+        self.trip_ids = trip_ids
+        self.taxi_ids = taxi_ids
+        self.depart_time = depart_time
+        self.waiting_time = waiting_time
+        self.duration = duration
+        self.length = length
+        self.time_loss = time_loss
+        self.row_indices: Dict[str, int] = None
+
+    def __len__(self):
+        return len(self.depart_time)
+
+    def __getitem__(self, index: int) -> TripInfo:
+        return TripInfo(
+            self.trip_ids[index],
+            self.taxi_ids[index],
+            float(self.depart_time[index]),
+            float(self.waiting_time[index]),
+            float(self.duration[index]),
+            float(self.length[index]),
+            float(self.time_loss[index])
+        )
+
+    def __iter__(self) -> Iterator[TripInfo]:
+        for i in range(len(self)):
+            yield self[i]
+
+    # Get the row of a trip by id, the index is built on first use
+    def row(self, trip_id: str) -> int:
+        if (self.row_indices == None):
+            self.row_indices = {trip_id: i for i, trip_id in enumerate(self.trip_ids)}
+        return self.row_indices[trip_id]
+
+    def to_dict(self) -> Dict[str, TripInfo]:
+        return {trip_info.trip_id: trip_info for trip_info in self}
+
+
+# Builds a TripInfoTable one record at a time
+class TripInfoTableBuilder:
+
+    def __init__(self):
+        self.trip_ids: List[str] = []
+        self.taxi_ids: List[str] = []
+        self.columns: List[Tuple[float, float, float, float, float]] = []
+
+    def add(self, trip_id: str, taxi_id: str, depart_time: float, waiting_time: float,
+            duration: float, length: float, time_loss: float):
+        self.trip_ids.append(trip_id)
+        self.taxi_ids.append(taxi_id)
+        self.columns.append((depart_time, waiting_time, duration, length, time_loss))
+
+    def build(self) -> TripInfoTable:
+        columns = np.array(self.columns, dtype=np.float64).reshape(-1, 5)
+        return TripInfoTable(
+            StringTable.from_strings(self.trip_ids),
+            StringTable.from_strings(self.taxi_ids),
+            *(np.ascontiguousarray(columns[:, i]) for i in range(5))
+        )
+
+
+def open_input(path: str):
+    if (path.endswith('.gz')):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+# Stream the children of the root element of an XML file, each child is cleared
+# once it has been handled so memory use doesn't grow with the size of the file
+def iter_records(path: str, tag: str) -> Iterator[ET.Element]:
+    with open_input(path) as openfile:
+        depth = 0
+        root = None
+        for event, elem in ET.iterparse(openfile, events=('start', 'end')):
+            if (event == 'start'):
+                if (root == None):
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if (depth == 1):
+                if (elem.tag == tag):
+                    yield elem
+                root.clear()
+
+# Read the tripinfo elements of a SUMO tripinfo output, as written by the base simulation
+def read_trip_infos(path: str) -> TripInfoTable:
+    builder = TripInfoTableBuilder()
+    for trip_info in iter_records(path, 'tripinfo'):
+        builder.add(
+            trip_info.attrib['id'],
+            '',
+            float(trip_info.attrib['depart']),
+            0.0,
+            float(trip_info.attrib['duration']),
+            float(trip_info.attrib['routeLength']),
+            float(trip_info.attrib['timeLoss'])
+        )
+    return builder.build()
+
+# Read the taxi rides of the personinfo elements of a SUMO tripinfo output, as
+# written by the taxi simulation, people without a ride element are left out
+def read_ride_infos(path: str) -> TripInfoTable:
+    builder = TripInfoTableBuilder()
+    for person_info in iter_records(path, 'personinfo'):
+        ride_info = person_info.find('ride')
+        if (ride_info == None):
+            continue
+        builder.add(
+            person_info.attrib['id'],
+            ride_info.attrib['vehicle'],
+            float(person_info.attrib['depart']),
+            float(ride_info.attrib['waitingTime']),
+            float(ride_info.attrib['duration']),
+            float(ride_info.attrib['routeLength']),
+            float(ride_info.attrib['timeLoss'])
+        )
+    return builder.build()
+
+
+# Aggregate figures for the trips departing in each hour, percentiles are
+# given in the order of kpi_percentiles with one row per hour. trip_km is the
+# distance travelled by the trips themselves, for taxi rides that is passenger
+# km, which leaves out driving to pickups and counts shared rides once per
+# passenger, so vkt holds the distance driven by the vehicles in each hour
+@dataclass
+class TripKpis:
+    hours: np.ndarray
+    trip_counts: np.ndarray
+    trip_km: np.ndarray
+    vkt: np.ndarray
+    waiting_time: np.ndarray
+    duration: np.ndarray
+    time_loss: np.ndarray
+
+    @property
+    def total_trip_km(self) -> float:
+        return float(self.trip_km.sum())
+
+    @property
+    def total_vkt(self) -> float:
+        return float(self.vkt.sum())
+
+# Kilometres driven by a taxi fleet in each of the given hours, from the running totals
+# of its simulation logs. Driving in hours without any departures, such as after the
+# last trip, is counted in the hour before it, or the first hour if there is none
+def hourly_fleet_vkt(hours: np.ndarray, simulation_logs: Sequence[TaxiSimulationLog]) -> np.ndarray:
+    vkt = np.zeros(len(hours))
+    if (len(hours) == 0):
+        return vkt
+    previous_fleet_vkt = 0.0
+    for log in simulation_logs:
+        i = max(int(np.searchsorted(hours, log.time_step // 3600, side='right')) - 1, 0)
+        vkt[i] += log.fleet_vkt - previous_fleet_vkt
+        previous_fleet_vkt = log.fleet_vkt
+    return vkt
+
+# Compute the KPIs of trips, which are taken to be made in their own vehicles
+# unless the simulation logs of the taxi fleet carrying them are given
+def compute_kpis(table: TripInfoTable, simulation_logs: Sequence[TaxiSimulationLog] = None) -> TripKpis:
+    trip_hours = (np.asarray(table.depart_time) // 3600).astype(np.int64)
+    order = np.argsort(trip_hours, kind='stable')
+    hours, starts, trip_counts = np.unique(trip_hours[order], return_index=True, return_counts=True)
+
+    # Sum of route lengths in kilometres
+    trip_km = np.bincount(np.searchsorted(hours, trip_hours), weights=table.length, minlength=len(hours)) / 1000
+    vkt = trip_km if simulation_logs == None else hourly_fleet_vkt(hours, simulation_logs)
+
+    def hourly_percentiles(values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values)[order]
+        percentiles = np.empty((len(hours), len(kpi_percentiles)))
+        for i, (start, count) in enumerate(zip(starts, trip_counts)):
+            percentiles[i] = np.percentile(values[start:start+count], kpi_percentiles)
+        return percentiles
+
+    return TripKpis(hours, trip_counts, trip_km, vkt,
+                    hourly_percentiles(table.waiting_time),
+                    hourly_percentiles(table.duration),
+                    hourly_percentiles(table.time_loss))
+
+
+kpi_names = ('hours', 'trip_counts', 'trip_km', 'vkt', 'waiting_time', 'duration', 'time_loss')
+
+# Store trip infos and their KPIs in a compressed numpy archive
+def store_trip_infos(table: TripInfoTable, path: str, kpis: TripKpis = None):
+    if (kpis == None):
+        kpis = compute_kpis(table)
+    arrays = {}
+    for name in ('trip_ids', 'taxi_ids'):
+        strings = getattr(table, name)
+        if (not isinstance(strings, StringTable)):
+            strings = StringTable.from_strings(list(strings))
+        arrays[name + '.offsets'] = strings.offsets
+        arrays[name + '.blob'] = strings.blob
+    for name in ('depart_time', 'waiting_time', 'duration', 'length', 'time_loss'):
+        arrays[name] = np.asarray(getattr(table, name), dtype=np.float64)
+    for name in kpi_names:
+        arrays['kpis.' + name] = getattr(kpis, name)
+    with open(path, 'wb') as outp:
+        np.savez_compressed(outp, **arrays)
+
+def retrieve_trip_infos(path: str) -> Tuple[TripInfoTable, TripKpis]:
+    with np.load(path) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    table = TripInfoTable(
+        StringTable(arrays['trip_ids.offsets'], arrays['trip_ids.blob']),
+        StringTable(arrays['taxi_ids.offsets'], arrays['taxi_ids.blob']),
+        *(arrays[name] for name in ('depart_time', 'waiting_time', 'duration', 'length', 'time_loss'))
+    )
+    kpis = TripKpis(*(arrays['kpis.' + name] for name in kpi_names))
+    return table, kpis
+
+
+def print_kpis(name: str, kpis: TripKpis):
+    print('--{}-- {} trips, {:.1f} trip km, {:.1f} vehicle km'.format(
+        name.upper(), int(kpis.trip_counts.sum()), kpis.total_trip_km, kpis.total_vkt))
+    percentile_names = '/'.join('p{}'.format(percentile) for percentile in kpi_percentiles)
+    row_format = '{:>4} {:>6} {:>8} {:>8} {:>20} {:>20} {:>20}'
+    print(row_format.format('hour', 'trips', 'trip km', 'vkm', *('{} {}'.format(column, percentile_names)
+                                                                 for column in ('waiting', 'duration', 'loss'))))
+    for i, hour in enumerate(kpis.hours):
+        print(row_format.format(
+            hour, kpis.trip_counts[i], '{:.1f}'.format(kpis.trip_km[i]), '{:.1f}'.format(kpis.vkt[i]),
+            *('/'.join('{:.0f}'.format(value) for value in percentiles[i])
+              for percentiles in (kpis.waiting_time, kpis.duration, kpis.time_loss))
+        ))
+
+# Print the KPIs of stored trip infos, eg. python3 tripinfo.py ../temp/base.tripinfo.npz ../temp/taxi_greedy.tripinfo.npz
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        print_kpis(path, retrieve_trip_infos(path)[1])
@@ -1,15 +1,29 @@
+from typing import Iterable, Iterator, List
+import gzip
 import os
 import pickle
 import xml.etree.ElementTree as ET
 
+from datatypes import Edge
+from network import Network, network_from_edges, store_network, retrieve_network
+
 # Creates a given folder
 def create_dir(path):
     exists = os.path.exists(path)
     if not exists:
         os.makedirs(path)
 
+# Networks are stored in a memory mapped binary format rather than pickled
+NETWORK_CACHE_EXTENSION = '.bin'
+
 # Store data in given file
 def store(data, path):
+    if (path.endswith(NETWORK_CACHE_EXTENSION)):
+        if (not isinstance(data, Network)):
+            data = network_from_edges(data)
+        store_network(data, path)
+        return
+
     with open(path, 'wb') as outp:
         if (type(data) == list):
             for item in data:
@@ -19,6 +33,9 @@ def store(data, path):
 
 # Retrieve data from given file
 def retrieve(path):
+    if (path.endswith(NETWORK_CACHE_EXTENSION)):
+        return retrieve_network(path)
+
     object_list = []
     with (open(path, "rb")) as openfile:
         while True:
@@ -31,6 +48,20 @@ def retrieve(path):
     else:
         return object_list
 
+# Retrieve items one at a time from a file written by store
+def retrieve_iter(path) -> Iterator:
+    with (open(path, "rb")) as openfile:
+        while True:
+            try:
+                yield pickle.load(openfile)
+            except EOFError:
+                break
+
+# Build binary network cache from an existing pickled list of edges
+def convert_edges_pickle(pickle_path: str, cache_path: str):
+    edges: List[Edge] = retrieve(pickle_path)
+    store(edges, cache_path)
+
 # Beautify XML 
 def indent(elem, level=0):
     i = "\n" + level*"  "
@@ -47,8 +78,32 @@ def indent(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
+# Open text file for writing, compressing it with gzip if the path ends in .gz
+def open_text_output(path: str):
+    if (path.endswith('.gz')):
+        return gzip.open(path, 'wt', encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+# Write elements under a root element one at a time, so that large files are written
+# without building the whole tree. The output is the same as writing the indented tree
+# with ElementTree.write, a root without elements is written as an empty element
+def write_xml_stream(path: str, root_tag: str, elements: Iterable[ET.Element]):
+    with open_text_output(path) as outp:
+        outp.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        outp.write('<' + root_tag)
+        empty = True
+        for element in elements:
+            if (empty):
+                outp.write('>')
+                empty = False
+            indent(element, 1)
+            element.tail = None
+            outp.write('\n  ' + ET.tostring(element, encoding='unicode'))
+        outp.write(' />' if empty else '\n</' + root_tag + '>\n')
+
 # Generate SUMO configuration file
-def generate_config(net_file: str, route_file: str, start_time: int, end_time: int, output_file: str, no_output=False):
+def generate_config(net_file: str, route_file: str, start_time: int, end_time: int, output_file: str, no_output=False,
+                    dispatch_period: int = 1):
     config_root = ET.Element("configuration")
 
     input_config = ET.SubElement(config_root, 'input')
@@ -73,7 +128,7 @@ def generate_config(net_file: str, route_file: str, start_time: int, end_time: i
         
     taxi_config = ET.SubElement(config_root, 'taxi-device')
     ET.SubElement(taxi_config, 'device.taxi.dispatch-algorithm', {'value': 'traci'})
-    ET.SubElement(taxi_config, 'device.taxi.dispatch-period', {'value': '1'})
+    ET.SubElement(taxi_config, 'device.taxi.dispatch-period', {'value': str(dispatch_period)})
     ET.SubElement(taxi_config, 'device.taxi.idle-algorithm', {'value': 'randomCircling'})
 
     config_tree = ET.ElementTree(config_root)
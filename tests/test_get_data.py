@@ -0,0 +1,92 @@
+import importlib.util
+import io
+import os
+import shutil
+import sys
+
+import pytest
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, src_dir)
+
+# Raw counts of two count points in the format of the DfT downloads, with a
+# byte order mark, one direction of travel per row and a count from 2020
+raw_counts_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'raw_counts.csv')
+
+
+# The stage needs SUMO and its mapping libraries to be imported at all
+@pytest.fixture(scope='module')
+def get_data():
+    if ('SUMO_HOME' not in os.environ):
+        pytest.skip('SUMO_HOME is not set')
+    for name in ('folium', 'pyproj', 'requests', 'shapely', 'utm'):
+        pytest.importorskip(name)
+    spec = importlib.util.spec_from_file_location('get_data', os.path.join(src_dir, '0-get_data.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Run from a stage directory next to a temp directory, like the stages are run
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'temp').mkdir()
+    monkeypatch.chdir(tmp_path / 'src')
+    return tmp_path / 'temp'
+
+
+def test_raw_counts_are_streamed_up_to_max_year(get_data):
+    raw_counts = list(get_data.stream_raw_counts(raw_counts_path, 2019))
+    assert [(raw_count[0], raw_count[2]) for raw_count in raw_counts] == \
+        [('1001', '2018'), ('1001', '2018'), ('1001', '2018'), ('2002', '2019'), ('2002', '2019')]
+    # The byte order mark is not part of the header, so the header is skipped
+    assert all(raw_count[0].isdigit() for raw_count in raw_counts)
+
+def test_raw_counts_are_streamed_from_a_binary_stream(get_data):
+    with open(raw_counts_path, 'rb') as inp:
+        stream = io.BytesIO(inp.read())
+    assert len(list(get_data.stream_raw_counts(stream, 2018))) == 3
+    # The stream is left open for whoever passed it
+    assert not stream.closed
+
+def test_streamed_raw_counts_are_aggregated(get_data):
+    count_points = get_data.aggregate_count_points(get_data.stream_raw_counts(raw_counts_path, 2019))
+
+    assert [count_point.id for count_point in count_points] == ['1001', '2002']
+    first, second = count_points
+    assert (first.road_name, first.latitude, first.longitude) == ('A36', 51.38, -2.36)
+    # Both directions of travel at 8 go into one average, the 2020 count is left out
+    assert [(count.hour, count.value_sum, count.value_count) for count in first.counts] == [(8, 600, 2), (9, 350, 1)]
+    assert [(count.hour, count.value_sum, count.value_count) for count in second.counts] == [(8, 200, 2)]
+
+def test_cached_raw_counts_file_is_used(get_data, temp_dir, monkeypatch):
+    shutil.copy(raw_counts_path, temp_dir / 'dft_rawcount_local_authority_id_121.csv')
+    def get(*args, **kwargs):
+        raise AssertionError('raw counts were downloaded again')
+    monkeypatch.setattr(get_data.requests, 'get', get)
+
+    path = get_data.get_raw_counts_file(121)
+    assert os.path.samefile(path, temp_dir / 'dft_rawcount_local_authority_id_121.csv')
+
+def test_raw_counts_file_is_downloaded_in_chunks(get_data, temp_dir, monkeypatch):
+    with open(raw_counts_path, 'rb') as inp:
+        content = inp.read()
+    class Response:
+        def raise_for_status(self):
+            pass
+        def iter_content(self, chunk_size):
+            for i in range(0, len(content), 100):
+                yield content[i:i+100]
+    requested_urls = []
+    def get(url, stream=False):
+        assert stream
+        requested_urls.append(url)
+        return Response()
+    monkeypatch.setattr(get_data.requests, 'get', get)
+
+    path = get_data.get_raw_counts_file(121)
+    assert requested_urls[0].endswith('/dft_rawcount_local_authority_id_121.csv')
+    assert sorted(os.listdir(temp_dir)) == ['dft_rawcount_local_authority_id_121.csv']
+    with open(path, 'rb') as inp:
+        assert inp.read() == content
+    assert len(get_data.aggregate_count_points(get_data.stream_raw_counts(path, 2019))) == 2
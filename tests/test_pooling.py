@@ -0,0 +1,104 @@
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from pooling import Stop, insert_reservation, dropoff_duration
+
+
+# Edges along a straight road, 100 seconds apart
+edge_positions = {'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': 4, 'f': 5}
+
+def travel_time(from_edge_id, to_edge_id):
+    return 100.0*abs(edge_positions[from_edge_id] - edge_positions[to_edge_id])
+
+def reservation_stops(reservation_id, from_edge_id, to_edge_id, person_count=1, pickup_deadline=math.inf):
+    return (Stop(reservation_id, from_edge_id, True, person_count, pickup_deadline),
+            Stop(reservation_id, to_edge_id, False, person_count, math.inf))
+
+def stop_names(insertion):
+    return [('pickup ' if stop.is_pickup else 'dropoff ') + stop.reservation_id for stop in insertion.stops]
+
+
+def test_reservation_is_inserted_into_empty_taxi():
+    pickup, dropoff = reservation_stops('1', 'b', 'd')
+    insertion = insert_reservation('a', 1000.0, [], 0, 8, pickup, dropoff, 500.0, travel_time)
+
+    assert stop_names(insertion) == ['pickup 1', 'dropoff 1']
+    assert insertion.arrival_times == [1100.0, 1300.0]
+    assert insertion.cost == 300.0 + dropoff_duration
+    # The drop-off has to be reached within the ride time of the pickup
+    assert insertion.stops[1].deadline == 1100.0 + 500.0
+
+def test_people_in_taxi_never_exceed_capacity():
+    existing = [Stop('0', 'd', False, 3, math.inf)]
+    pickup, dropoff = reservation_stops('1', 'b', 'c', person_count=2)
+
+    # There is room to pick them up on the way
+    insertion = insert_reservation('a', 0.0, existing, 3, 5, pickup, dropoff, 1000.0, travel_time)
+    assert stop_names(insertion) == ['pickup 1', 'dropoff 1', 'dropoff 0']
+
+    # Otherwise they are only picked up once the taxi has dropped off the people in it
+    insertion = insert_reservation('a', 0.0, existing, 3, 4, pickup, dropoff, 1000.0, travel_time)
+    assert stop_names(insertion) == ['dropoff 0', 'pickup 1', 'dropoff 1']
+
+    # Nor can more people be picked up than the taxi seats
+    pickup, dropoff = reservation_stops('1', 'b', 'c', person_count=5)
+    assert insert_reservation('a', 0.0, existing, 3, 4, pickup, dropoff, 1000.0, travel_time) == None
+
+def test_pickup_is_reached_by_its_deadline():
+    pickup, dropoff = reservation_stops('1', 'e', 'f', pickup_deadline=399.0)
+    assert insert_reservation('a', 0.0, [], 0, 8, pickup, dropoff, 1000.0, travel_time) == None
+
+    pickup, dropoff = reservation_stops('1', 'e', 'f', pickup_deadline=400.0)
+    insertion = insert_reservation('a', 0.0, [], 0, 8, pickup, dropoff, 1000.0, travel_time)
+    assert insertion.arrival_times[0] == 400.0
+
+    # A pickup which can only be reached after the stops of the taxi is late as well
+    existing = [Stop('0', 'f', False, 1, math.inf)]
+    pickup, dropoff = reservation_stops('1', 'a', 'b', pickup_deadline=500.0)
+    assert insert_reservation('c', 0.0, existing, 8, 8, pickup, dropoff, 1000.0, travel_time) == None
+
+def test_ride_takes_at_most_max_ride_time():
+    existing = [Stop('0', 'c', False, 1, math.inf)]
+    pickup, dropoff = reservation_stops('1', 'b', 'd')
+
+    # Cheapest is to drop the people in the taxi off on the way, which makes the ride 260 seconds
+    insertion = insert_reservation('a', 0.0, existing, 1, 8, pickup, dropoff, 300.0, travel_time)
+    assert stop_names(insertion) == ['pickup 1', 'dropoff 0', 'dropoff 1']
+    assert insertion.arrival_times[2] - insertion.arrival_times[0] == 200.0 + dropoff_duration
+
+    # When that is too long they are taken straight to their destination
+    insertion = insert_reservation('a', 0.0, existing, 1, 8, pickup, dropoff, 250.0, travel_time)
+    assert stop_names(insertion) == ['pickup 1', 'dropoff 1', 'dropoff 0']
+    assert insertion.arrival_times[1] - insertion.arrival_times[0] == 200.0
+
+    assert insert_reservation('a', 0.0, existing, 1, 8, pickup, dropoff, 199.0, travel_time) == None
+
+def test_existing_stops_are_not_made_late():
+    pickup, dropoff = reservation_stops('1', 'b', 'a')
+
+    # Going the other way first delays the drop-off at e from 200 to 660 seconds, which
+    # is allowed before its deadline
+    existing = [Stop('0', 'e', False, 1, 700.0)]
+    insertion = insert_reservation('c', 0.0, existing, 1, 8, pickup, dropoff, 1000.0, travel_time)
+    assert stop_names(insertion) == ['pickup 1', 'dropoff 1', 'dropoff 0']
+    assert insertion.arrival_times[2] == 660.0
+
+    # A stop without a deadline can't be reached any later than it is now
+    existing = [Stop('0', 'e', False, 1, -math.inf)]
+    insertion = insert_reservation('c', 0.0, existing, 1, 8, pickup, dropoff, 1000.0, travel_time)
+    assert stop_names(insertion) == ['dropoff 0', 'pickup 1', 'dropoff 1']
+    assert insertion.arrival_times[0] == 200.0
+
+    # Stops which are already late can still be reached as late as they are now
+    existing = [Stop('0', 'e', False, 1, 100.0)]
+    insertion = insert_reservation('c', 0.0, existing, 1, 8, pickup, dropoff, 1000.0, travel_time)
+    assert stop_names(insertion) == ['dropoff 0', 'pickup 1', 'dropoff 1']
+
+def test_unreachable_stops_are_not_inserted():
+    pickup, dropoff = reservation_stops('1', 'b', 'x')
+    def partial_travel_time(from_edge_id, to_edge_id):
+        return None if 'x' in (from_edge_id, to_edge_id) else travel_time(from_edge_id, to_edge_id)
+    assert insert_reservation('a', 0.0, [], 0, 8, pickup, dropoff, 1000.0, partial_travel_time) == None
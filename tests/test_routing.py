@@ -0,0 +1,89 @@
+import heapq
+import math
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from network import NetworkBuilder
+from routing import Router
+
+
+# Random network of single lane edges along the x axis, joined by random connections.
+# Returns the network along with the travel time of each edge, and the edges
+# taxis may use along with the connections between them, worked out separately
+def random_network(seed, edge_count=30, connection_count=70):
+    rng = random.Random(seed)
+    builder = NetworkBuilder()
+    travel_times = []
+    allowed = []
+    for i in range(edge_count):
+        length = rng.uniform(10, 500)
+        speed = rng.choice([8.33, 13.89, 22.22])
+        is_allowed = rng.random() > 0.1
+        builder.add_lane('e{}_0'.format(i), speed, [[0.0, 0.0], [length, 0.0]], '', '' if is_allowed else 'taxi')
+        builder.add_edge('e{}'.format(i), True)
+        travel_times.append(length / speed)
+        allowed.append(is_allowed)
+
+    successors = {i: set() for i in range(edge_count)}
+    for _ in range(connection_count):
+        from_edge, to_edge = rng.randrange(edge_count), rng.randrange(edge_count)
+        builder.add_connection('e{}_0'.format(from_edge), 'e{}_0'.format(to_edge))
+        if (allowed[from_edge] and allowed[to_edge]):
+            successors[from_edge].add(to_edge)
+    return builder.build(), travel_times, allowed, successors
+
+# Plain Dijkstra from one edge, the cost of a route being the travel times of all of its edges
+def brute_force_times(from_edge, travel_times, successors):
+    times = {from_edge: travel_times[from_edge]}
+    heap = [(travel_times[from_edge], from_edge)]
+    while heap:
+        time, edge = heapq.heappop(heap)
+        if (time > times[edge]):
+            continue
+        for successor in successors[edge]:
+            new_time = time + travel_times[successor]
+            if (new_time < times.get(successor, math.inf)):
+                times[successor] = new_time
+                heapq.heappush(heap, (new_time, successor))
+    return times
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_routes_match_brute_force_dijkstra(seed):
+    network, travel_times, allowed, successors = random_network(seed)
+    router = Router(network, 'taxi')
+
+    for from_edge in range(len(travel_times)):
+        expected_times = brute_force_times(from_edge, travel_times, successors) if allowed[from_edge] else {}
+        for to_edge in range(len(travel_times)):
+            time, path = router.route(from_edge, to_edge)
+            expected = expected_times.get(to_edge, math.inf) if allowed[to_edge] else math.inf
+            if (expected == math.inf):
+                assert time == math.inf and path == []
+                continue
+
+            assert time == pytest.approx(expected)
+            # The path joins the two edges through connections, and takes the time found
+            assert path[0] == from_edge and path[-1] == to_edge
+            assert all(path[i+1] in successors[path[i]] for i in range(len(path)-1))
+            assert sum(travel_times[edge] for edge in path) == pytest.approx(time)
+
+def test_found_routes_are_laid_out_like_sumo_routes():
+    network, travel_times, allowed, successors = random_network(0)
+    router = Router(network, 'taxi')
+
+    for from_edge in range(len(travel_times)):
+        for to_edge in range(len(travel_times)):
+            time, path = router.route(from_edge, to_edge)
+            route = router.find_route('e{}'.format(from_edge), 'e{}'.format(to_edge), 'taxi')
+            if (len(path) == 0):
+                assert route.length == 0 and route.edges == []
+                continue
+            assert route.edges == ['e{}'.format(edge) for edge in path]
+            assert route.travelTime == pytest.approx(time)
+            assert route.length == pytest.approx(sum(router.edge_lengths[edge] for edge in path))
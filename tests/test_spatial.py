@@ -0,0 +1,18 @@
+import os
+import sys
+
+from shapely.geometry import Point, box
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from spatial import LocalAuthorityLocator
+
+
+def test_last_local_authority_containing_a_point_wins():
+    locator = LocalAuthorityLocator(
+        [box(0, 0, 10, 10), box(5, 5, 15, 15), box(20, 20, 30, 30)],
+        [{'id': 1}, {'id': 2}, {'id': 3}]
+    )
+    located = locator.locate_many([Point(2, 2), Point(7, 7), Point(12, 12), Point(25, 25), Point(40, 40)])
+    assert [None if properties == None else properties['id'] for properties in located] == [1, 2, 2, 3, None]
+    assert locator.locate(Point(7, 7))['id'] == 2
@@ -0,0 +1,209 @@
+import importlib.util
+import os
+import sys
+import types
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, src_dir)
+
+
+# Stands in for traci, with a single straight road. Taxis are on it as soon as they
+# are added, at the position they were given, and dispatches are recorded
+class FakeTraci:
+
+    def __init__(self):
+        self.time = 0.0
+        self.positions = {}
+        self.states = {}
+        self.departed_ids = []
+        self.subscribed_ids = set()
+        self.person_positions = {}
+        self.dispatches = []
+        self.rejected_ids = set()
+        self.next_position = (0.0, 0.0)
+
+        fake = self
+        self.simulation = SimpleNamespace(
+            getTime=lambda: fake.time,
+            getDepartedIDList=lambda: list(fake.departed_ids),
+            findRoute=lambda from_edge, to_edge, vType='': SimpleNamespace(length=100.0, travelTime=10.0)
+        )
+        self.route = SimpleNamespace(add=lambda route_id, edges: None)
+        self.person = SimpleNamespace(getPosition=lambda person_id: fake.person_positions[person_id])
+        self.vehicle = SimpleNamespace(
+            add=self.add_vehicle,
+            remove=self.remove_vehicle,
+            subscribe=lambda vehicle_id, variables: fake.subscribed_ids.add(vehicle_id),
+            unsubscribe=lambda vehicle_id: fake.subscribed_ids.discard(vehicle_id),
+            getAllSubscriptionResults=self.subscription_results,
+            getTaxiFleet=self.taxi_fleet,
+            dispatchTaxi=self.dispatch_taxi
+        )
+
+    def add_vehicle(self, vehicle_id, route_id, type_id, depart=None, line=''):
+        self.positions[vehicle_id] = self.next_position
+        self.states[vehicle_id] = 0
+        self.departed_ids.append(vehicle_id)
+
+    def remove_vehicle(self, vehicle_id):
+        del self.positions[vehicle_id]
+        del self.states[vehicle_id]
+
+    def subscription_results(self):
+        tc = sys.modules['sumo_backend'].tc
+        return {vehicle_id: {tc.VAR_POSITION: self.positions[vehicle_id], tc.VAR_ROAD_ID: 'road', tc.VAR_DISTANCE: 0.0}
+                for vehicle_id in self.subscribed_ids if vehicle_id in self.positions}
+
+    # Like SUMO, taxis in state 3 are also listed for states 1 and 2
+    def taxi_fleet(self, state):
+        if (state == 0):
+            return [vehicle_id for vehicle_id, taxi_state in self.states.items() if taxi_state == 0]
+        return [vehicle_id for vehicle_id, taxi_state in self.states.items() if taxi_state & state == state]
+
+    def dispatch_taxi(self, vehicle_id, reservation_ids):
+        if (reservation_ids[0] in self.rejected_ids):
+            raise RuntimeError('rejected')
+        self.dispatches.append((vehicle_id, list(reservation_ids)))
+        self.states[vehicle_id] = 1
+
+    # Move to the next step, taxis which were added are seen as departed
+    def step(self):
+        self.time += 1
+        self.departed_ids = [vehicle_id for vehicle_id in self.departed_ids if vehicle_id not in self.subscribed_ids]
+
+
+@pytest.fixture
+def taxi_run(tmp_path, monkeypatch):
+    fake_traci = FakeTraci()
+    sumo_backend = types.ModuleType('sumo_backend')
+    sumo_backend.tc = SimpleNamespace(VAR_POSITION=0x42, VAR_ROAD_ID=0x50, VAR_DISTANCE=0x84)
+    sumo_backend.checkBinary = lambda name: name
+    sumo_backend.load_backend = lambda name=None: fake_traci
+    sumo_backend.add_backend_argument = lambda parser: None
+    monkeypatch.setitem(sys.modules, 'sumo_backend', sumo_backend)
+    monkeypatch.delitem(sys.modules, 'fleet', raising=False)
+
+    spec = importlib.util.spec_from_file_location('taxi_run', os.path.join(src_dir, '4-run_taxi_simulation.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    from fleet import FleetSnapshot
+    from routing import RouteCache
+    from spatial import PointGrid
+    from telemetry import TelemetrySink
+    module.fleet_snapshot = FleetSnapshot(fake_traci)
+    module.idle_taxi_grid = PointGrid(module.idle_taxi_cell_size)
+    module.route_cache = RouteCache(fake_traci.simulation.findRoute)
+    module.drivable_edges = ['road']
+    telemetry = TelemetrySink(str(tmp_path / 'telemetry.csv'), str(tmp_path / 'log.pkl'), str(tmp_path / 'dispatch.pkl'))
+    yield module, fake_traci, telemetry
+    telemetry.close()
+
+def reservation(fake_traci, reservation_id, position):
+    fake_traci.person_positions['p' + reservation_id] = position
+    return SimpleNamespace(id=reservation_id, persons=['p' + reservation_id], fromEdge='road', toEdge='road',
+                           reservationTime=fake_traci.time, state=1)
+
+# Step the simulation and bring the fleet up to date, as the main loop does
+def step(module, fake_traci):
+    fake_traci.step()
+    return module.update_fleet()
+
+def add_taxis(module, fake_traci, positions):
+    for position in positions:
+        fake_traci.next_position = position
+        module.new_taxi()
+
+
+@pytest.mark.parametrize('policy', ['first', 'greedy', 'batch'])
+def test_no_reservation_is_skipped(taxi_run, policy):
+    module, fake_traci, telemetry = taxi_run
+    module.dispatch_policy = policy
+    add_taxis(module, fake_traci, [(0.0, 0.0), (100.0, 0.0), (200.0, 0.0)])
+    idle_taxis = step(module, fake_traci)
+    assert len(idle_taxis) == 3
+
+    # More reservations than taxis, one after the other in the queue
+    queue = deque(reservation(fake_traci, str(i), (50.0*i, 0.0)) for i in range(7))
+    dispatches, _ = module.dispatch_reservations(queue, idle_taxis, telemetry)
+
+    dispatched_ids = [reservation_ids[0] for _, reservation_ids in fake_traci.dispatches]
+    assert dispatches == 3
+    assert len(set(dispatched_ids)) == 3
+    # Every reservation is either dispatched or still queued, in the order it was queued
+    assert sorted(dispatched_ids + [queued.id for queued in queue], key=int) == [str(i) for i in range(7)]
+    assert [queued.id for queued in queue] == [str(i) for i in range(7) if str(i) not in dispatched_ids]
+    assert len(idle_taxis) == 0
+
+    # Once taxis are free again, the queued reservations are all dispatched
+    for vehicle_id in fake_traci.states:
+        fake_traci.states[vehicle_id] = 0
+    add_taxis(module, fake_traci, [(300.0, 0.0)])
+    idle_taxis = step(module, fake_traci)
+    assert len(idle_taxis) == 4
+    dispatches, _ = module.dispatch_reservations(queue, idle_taxis, telemetry)
+    assert dispatches == 4
+    assert len(queue) == 0
+    assert sorted(reservation_ids[0] for _, reservation_ids in fake_traci.dispatches) == sorted(str(i) for i in range(7))
+
+def test_rejected_dispatch_does_not_skip_the_next_reservation(taxi_run):
+    module, fake_traci, telemetry = taxi_run
+    module.dispatch_policy = 'greedy'
+    add_taxis(module, fake_traci, [(0.0, 0.0), (100.0, 0.0)])
+    idle_taxis = step(module, fake_traci)
+
+    fake_traci.rejected_ids.add('0')
+    queue = deque(reservation(fake_traci, str(i), (0.0, 0.0)) for i in range(3))
+    dispatches, _ = module.dispatch_reservations(queue, idle_taxis, telemetry)
+
+    # The rejected reservation is dropped, the taxi stays idle and takes the next one
+    assert dispatches == 2
+    assert [reservation_ids[0] for _, reservation_ids in fake_traci.dispatches] == ['1', '2']
+    assert len(queue) == 0
+
+def test_fleet_state_follows_overlapping_taxi_fleets(taxi_run):
+    module, fake_traci, _ = taxi_run
+    add_taxis(module, fake_traci, [(0.0, 0.0)])
+    step(module, fake_traci)
+    taxi_id = next(iter(fake_traci.states))
+    TaxiStates = module.TaxiStates
+
+    for state in (TaxiStates.pickup, TaxiStates.pickup_occupied, TaxiStates.occupied,
+                  TaxiStates.pickup_occupied, TaxiStates.pickup, TaxiStates.idle):
+        fake_traci.states[taxi_id] = state.value
+        step(module, fake_traci)
+        assert module.fleet.states[taxi_id] == state
+        assert {other for other in (TaxiStates.idle, TaxiStates.pickup, TaxiStates.occupied, TaxiStates.pickup_occupied)
+                if taxi_id in module.fleet.in_state(other)} == {state}
+
+def test_distance_of_vanished_taxis_is_kept(taxi_run):
+    module, fake_traci, _ = taxi_run
+    tc = sys.modules['sumo_backend'].tc
+    # Like traci, subscription results are one dict which is cleared and refilled every step
+    results = {}
+    distances = {}
+    def subscription_results():
+        results.clear()
+        for vehicle_id in fake_traci.subscribed_ids:
+            if (vehicle_id in fake_traci.positions):
+                results[vehicle_id] = {tc.VAR_POSITION: fake_traci.positions[vehicle_id], tc.VAR_ROAD_ID: 'road',
+                                       tc.VAR_DISTANCE: distances.get(vehicle_id, 0.0)}
+        return results
+    fake_traci.vehicle.getAllSubscriptionResults = subscription_results
+
+    add_taxis(module, fake_traci, [(0.0, 0.0), (100.0, 0.0)])
+    step(module, fake_traci)
+    vanishing_id, staying_id = list(fake_traci.states)
+    distances.update({vanishing_id: 1500.0, staying_id: 500.0})
+    step(module, fake_traci)
+
+    # One taxi leaves the simulation by itself, the other is removed
+    del fake_traci.positions[vanishing_id]
+    del fake_traci.states[vanishing_id]
+    step(module, fake_traci)
+    module.remove_taxi(module.fleet[staying_id])
+    assert module.fleet_vkt() == pytest.approx(2.0)
@@ -0,0 +1,27 @@
+import copy
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utilities import indent, write_xml_stream
+
+
+def vehicle(vehicle_id, stop_count):
+    element = ET.Element('vehicle', {'id': vehicle_id, 'depart': '0.00'})
+    for i in range(stop_count):
+        ET.SubElement(element, 'stop', {'lane': 'edge_' + str(i) + '_0', 'duration': '60'})
+    return element
+
+@pytest.mark.parametrize('elements', [[], [vehicle('0', 0)], [vehicle('0', 2), vehicle('1', 0), vehicle('2', 1)]])
+def test_streamed_xml_is_the_same_as_the_written_tree(tmp_path, elements):
+    root = ET.Element('routes')
+    root.extend(copy.deepcopy(elements))
+    indent(root)
+    ET.ElementTree(root).write(str(tmp_path / 'tree.xml'), encoding='utf-8', xml_declaration=True)
+
+    write_xml_stream(str(tmp_path / 'stream.xml'), 'routes', iter(elements))
+    assert (tmp_path / 'stream.xml').read_bytes() == (tmp_path / 'tree.xml').read_bytes()